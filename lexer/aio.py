@@ -0,0 +1,189 @@
+import asyncio
+import codecs
+import sys
+
+from lexer import CharacterParser, PositionIndex, StringParser
+from incremental import Starved, lex_from
+
+# A source is lexed in steps on the event loop's executor, so any number of
+# connections share its bounded pool and an idle one holds no thread. Each
+# step lexes the text received since the last checkpoint, from the parser
+# states saved there. Checkpoints are clean positions at line starts, or
+# every _spacing characters on a long line. Tokens up to the last checkpoint
+# a step reaches are final and handed out; the rest is lexed again by a
+# later step once more text has arrived. A step that runs out of text
+# before the input ends stops with Starved.
+#
+# Each step's tokens resolve their line and column through a _Window over
+# that step's text only, based at the lines before it, so no index of the
+# whole stream is kept.
+
+_spacing = 4096
+
+class _Window:
+    def __init__(self, text, offset, line, line_start):
+        self.index = PositionIndex(text)
+        self.offset = offset
+        self.line = line
+        self.line_start = line_start
+
+    def position(self, offset):
+        line, column = self.index.position(offset - self.offset)
+        if line == 1:
+            column = offset - self.line_start + 1
+        return self.line + line - 1, column
+
+class _StreamLexer:
+    def __init__(self, name, stages, max_lookback):
+        self.name = name
+        self.stages = stages
+        self.max_lookback = max_lookback
+        self.text = ''
+        self.offset = 0
+        self.line = 1
+        self.line_start = 0
+        self.states = None
+        self.wanted = 0
+        self.carriage_return = False
+
+    def feed(self, chunk):
+        # normalize_newlines, one chunk at a time.
+        if self.carriage_return:
+            chunk = '\r' + chunk
+        self.carriage_return = chunk.endswith('\r')
+        if self.carriage_return:
+            chunk = chunk[:-1]
+        chunk = chunk.replace('\r\n', '\n').replace('\r', '\n')
+
+        self.text += chunk
+
+    def ready(self):
+        # Text that cannot be cut at a line start yet (a long line, an open
+        # string) is only lexed again once it has doubled, so the total work
+        # stays linear in the input.
+        return len(self.text) >= self.wanted
+
+    def close(self):
+        if self.carriage_return:
+            self.text += '\n'
+            self.carriage_return = False
+
+    def step(self, final):
+        window = _Window(self.text, self.offset, self.line, self.line_start)
+        tokens = []
+        count = end = states = None
+        try:
+            for token, position, snapshot in lex_from(
+                    self.stages, self.text, 0, self.states, self.name,
+                    window, final, self.max_lookback):
+                tokens.append(token)
+                if final or position is None or position == 0:
+                    continue
+                if (
+                        self.text[position - 1] == '\n' or
+                        position - (end or 0) >= _spacing):
+                    count = len(tokens)
+                    end = position
+                    states = snapshot()
+        except Starved:
+            pass
+
+        if final:
+            self.text = ''
+            return tokens
+
+        if count is None:
+            tokens = []
+        else:
+            self.offset += end
+            self.line, column = window.position(self.offset)
+            self.line_start = self.offset - column + 1
+            self.text = self.text[end:]
+            self.states = states
+            tokens = tokens[:count]
+        self.wanted = 2*len(self.text)
+        return tokens
+
+def _decode(decoder, data, encoding):
+    if not isinstance(data, bytes):
+        return decoder, data
+    if decoder is None:
+        decoder = codecs.getincrementaldecoder(encoding)()
+    return decoder, decoder.decode(data, final=not data)
+
+# Lexes everything read from reader (anything with an awaitable read(n),
+# such as an asyncio.StreamReader), yielding tokens as they are produced.
+# Steps run on executor, or the loop's default executor if None.
+async def lex_stream(reader, name='<stream>', stages=None,
+                     chunk_size=1 << 16, encoding='utf-8', max_lookback=None,
+                     executor=None):
+    loop = asyncio.get_running_loop()
+    if stages is None:
+        stages = [CharacterParser, StringParser]
+
+    lexer = _StreamLexer(name, stages, max_lookback)
+    decoder = None
+    reading = asyncio.ensure_future(reader.read(chunk_size))
+    try:
+        while True:
+            data = await reading
+            reading = None
+            decoder, text = _decode(decoder, data, encoding)
+            final = not data
+            if text:
+                lexer.feed(text)
+            if final:
+                lexer.close()
+            else:
+                # Read ahead while the step runs.
+                reading = asyncio.ensure_future(reader.read(chunk_size))
+
+            if final or lexer.ready():
+                for token in await loop.run_in_executor(
+                        executor, lexer.step, final):
+                    yield token
+
+            if final:
+                break
+    finally:
+        if reading is not None:
+            reading.cancel()
+            try:
+                await reading
+            except (asyncio.CancelledError, Exception):
+                pass
+
+# Awaitable reads from a regular file, for inputs that cannot be attached
+# to the event loop as a pipe.
+class FileReader:
+    def __init__(self, f):
+        self.f = f
+
+    async def read(self, n):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.f.read, n)
+
+async def _stdin_reader():
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    try:
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except ValueError:
+        return FileReader(sys.stdin.buffer)
+    return reader
+
+async def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--max-lookback', type=int, default=None,
+                        help='bound the items a tokenizer may read ahead')
+    args = parser.parse_args(argv)
+
+    async for token in lex_stream(
+            await _stdin_reader(), '<stdin>', max_lookback=args.max_lookback):
+        print('[' + str(token) + ']')
+
+if __name__ == '__main__':
+    asyncio.run(main())
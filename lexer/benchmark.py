@@ -0,0 +1,183 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from lexer import (
+    CharacterParser, FilenameParser, IndentParser, Parser,
+    ReversibleIterator, StringParser)
+
+def _fill(size, rng, line):
+    lines = []
+    length = 0
+    while length < size:
+        text = line(rng)
+        lines.append(text)
+        length += len(text)
+    return ''.join(lines)
+
+def strings_corpus(size, rng):
+    def line(rng):
+        parts = []
+        for _ in range(rng.randint(1, 6)):
+            parts.append(rng.choice((
+                'plain text',
+                '\\x{:02x}'.format(rng.randrange(256)),
+                '\\u{:04x}'.format(rng.randrange(0x10000)),
+                '\\n', '\\t', '\\\\',
+            )))
+        quote = rng.choice('"\'`')
+        return 'value = {0}{1}{0}\n'.format(quote, ' '.join(parts))
+    return _fill(size, rng, line)
+
+def indent_corpus(size, rng):
+    state = {'depth': 0}
+    def line(rng):
+        state['depth'] = max(0, min(16, state['depth'] + rng.choice((-1, 0, 1))))
+        return '{}stmt_{} = call(x)\n'.format(
+            '    ' * state['depth'], rng.randrange(1000))
+    return _fill(size, rng, line)
+
+words = (
+    'parser', 'token', 'stream', 'state', 'next', 'push', 'pop', 'return',
+    'if', 'else', 'None', 'predicate', 'text', 'frag0', 'number_fragment',
+)
+
+def identifier_corpus(size, rng):
+    def line(rng):
+        return '    {} = {}({}, {})\n'.format(
+            rng.choice(words), rng.choice(words),
+            rng.choice(words), rng.randrange(100))
+    return _fill(size, rng, line)
+
+def crlf_corpus(size, rng):
+    return identifier_corpus(size, rng).replace('\n', '\r\n')
+
+corpora = {
+    'strings': strings_corpus,
+    'indent': indent_corpus,
+    'identifiers': identifier_corpus,
+    'crlf': crlf_corpus,
+}
+
+def _drain(stream):
+    tokens = []
+    while True:
+        token = stream.next()
+        if token is None:
+            return tokens
+        tokens.append(token)
+
+def _run_stages(stages, items):
+    stream = ReversibleIterator(items)
+    for stage in stages:
+        stream = Parser(stage.tokenizers).parse(stream)
+    return _drain(stream)
+
+def stage_cases(fname):
+    filenames = [fname]
+    characters = _run_stages((FilenameParser,), filenames)
+    strings = _run_stages((CharacterParser,), characters)
+    return {
+        'filename': ((FilenameParser,), filenames),
+        'character': ((CharacterParser,), characters),
+        'string': ((StringParser,), strings),
+        'indent': ((IndentParser,), strings),
+        'pipeline': (
+            (FilenameParser, CharacterParser, StringParser), filenames),
+    }
+
+def measure(stages, items, memory=True):
+    start = time.perf_counter()
+    tokens = _run_stages(stages, items)
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        _run_stages(stages, items)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return len(tokens), seconds, peak
+
+def _revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shapes', nargs='*', default=list(corpora))
+    parser.add_argument('--stages', nargs='*', default=None)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('-o', '--output', default=None)
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for shape in args.shapes:
+            text = corpora[shape](args.size, random.Random(args.seed))
+            fname = os.path.join(tmp, shape + '.txt')
+            with open(fname, 'w', newline='') as f:
+                f.write(text)
+
+            cases = stage_cases(fname)
+            for stage in (args.stages or cases):
+                stages, items = cases[stage]
+                result = {'shape': shape, 'stage': stage, 'chars': len(text)}
+                try:
+                    tokens, seconds, peak = measure(
+                        stages, items, not args.no_memory)
+                except Exception as e:
+                    result['error'] = '{}: {}'.format(
+                        e.__class__.__name__, e)
+                else:
+                    result.update({
+                        'tokens': tokens,
+                        'seconds': seconds,
+                        'chars_per_second': len(text)/seconds,
+                        'tokens_per_second': tokens/seconds,
+                        'peak_bytes': peak,
+                    })
+                results.append(result)
+                print('{shape:12} {stage:10} {summary}'.format(
+                    shape=shape, stage=stage, summary=(
+                        result.get('error') or
+                        '{:10.0f} chars/s {:10.0f} tokens/s'.format(
+                            result['chars_per_second'],
+                            result['tokens_per_second']))),
+                    file=sys.stderr)
+
+    report = {
+        'meta': {
+            'revision': _revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'size': args.size,
+            'seed': args.seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
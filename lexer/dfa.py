@@ -0,0 +1,143 @@
+from lexer import ReversibleIterator, identifier, identity
+
+class Rule:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_class = getattr(tokenizer, 'token_class', None)
+        self.substring = getattr(tokenizer, 'substring', None)
+        self.charset = getattr(tokenizer, 'charset', None)
+        self.follow = None
+
+        if hasattr(tokenizer, 'keyword'):
+            self.follow = identifier.charset
+
+        compilable = (
+            self.token_class is not None and
+            bool(self.substring) != bool(self.charset) and
+            not hasattr(tokenizer, 'pushes') and
+            not hasattr(tokenizer, 'pops')
+        )
+
+        if not compilable:
+            raise ValueError(
+                'tokenizer {} cannot be compiled'.format(
+                    getattr(tokenizer, '__name__', tokenizer)))
+
+    def make(self, text, start, end):
+        if self.charset:
+            return self.token_class(text=text[start:end])
+        return self.token_class()
+
+class DFAScanner:
+    def __init__(self, tokenizers):
+        self.fallback = False
+        self.rules = []
+
+        for tokenizer in tokenizers:
+            if tokenizer is identity:
+                self.fallback = True
+                break
+            self.rules.append(Rule(tokenizer))
+
+        self._build()
+
+    def _step(self, items, c):
+        result = set()
+        for item in items:
+            kind, index, k = item
+            rule = self.rules[index]
+            if kind == 'lit':
+                if k < len(rule.substring) and rule.substring[k] == c:
+                    result.add(('lit', index, k + 1))
+            elif c in rule.charset:
+                result.add(('run', index, 0))
+        return frozenset(result)
+
+    def _accepts(self, items):
+        result = set()
+        for kind, index, k in items:
+            if kind == 'run' or (
+                    kind == 'lit' and k == len(self.rules[index].substring)):
+                result.add(index)
+        return sorted(result)
+
+    def _build(self):
+        alphabet = set()
+        start = set()
+        for index, rule in enumerate(self.rules):
+            if rule.charset:
+                alphabet.update(rule.charset)
+                start.add(('start', index, 0))
+            else:
+                alphabet.update(rule.substring)
+                start.add(('lit', index, 0))
+
+        start = frozenset(start)
+        numbers = {start: 0}
+        pending = [start]
+        self.transitions = [{}]
+        self.accepts = [[]]
+
+        while pending:
+            items = pending.pop()
+            transitions = self.transitions[numbers[items]]
+            for c in alphabet:
+                target = self._step(items, c)
+                if not target:
+                    continue
+
+                if target not in numbers:
+                    numbers[target] = len(self.transitions)
+                    self.transitions.append({})
+                    self.accepts.append(self._accepts(target))
+                    pending.append(target)
+
+                transitions[c] = numbers[target]
+
+    def scan_spans(self, text, pos=0):
+        transitions = self.transitions
+        accepts = self.accepts
+        rules = self.rules
+        n = len(text)
+
+        while pos < n:
+            state = 0
+            i = pos
+            match = None
+            match_end = pos
+
+            while i < n:
+                state = transitions[state].get(text[i])
+                if state is None:
+                    break
+                i += 1
+
+                for index in accepts[state]:
+                    follow = rules[index].follow
+                    if follow and i < n and text[i] in follow:
+                        continue
+                    match = index
+                    match_end = i
+                    break
+
+            if match is None:
+                if not self.fallback:
+                    return
+                match_end = pos + 1
+
+            yield (match, pos, match_end)
+            pos = match_end
+
+    def scan(self, text, pos=0):
+        rules = self.rules
+        for index, start, end in self.scan_spans(text, pos):
+            if index is None:
+                yield text[start]
+            else:
+                yield rules[index].make(text, start, end)
+
+    def parse(self, text):
+        return ReversibleIterator(self.scan(text))
+
+def compile_parser(parser):
+    return DFAScanner(parser.tokenizers)
@@ -0,0 +1,87 @@
+import itertools as it
+
+from lexer import Cursor, ReversibleIterator
+
+class ItemStream:
+    memo = None
+
+    def __init__(self):
+        self.item = None
+        self.consumed = False
+        self.state_stack = []
+
+    def reset(self, item):
+        self.item = item
+        self.consumed = False
+
+    def push(self):
+        self.state_stack.append(self.consumed)
+
+    def apply(self, state=None):
+        if state is None:
+            state = self.state_stack[-1]
+
+        self.consumed = state
+
+    def pop(self):
+        self.consumed = self.state_stack.pop()
+
+    def drop(self):
+        self.state_stack.pop()
+
+    def rewind_distance(self):
+        return int(self.consumed) - int(self.state_stack[-1])
+
+    def put(self, obj):
+        if not self.consumed or obj is not self.item:
+            raise ValueError('ItemStream can only put back its current item')
+        self.consumed = False
+
+    def peek(self):
+        if self.consumed:
+            raise ValueError('stage read past its single item of lookahead')
+        return self.item
+
+    def next(self):
+        if self.consumed:
+            raise ValueError('stage read past its single item of lookahead')
+        self.consumed = True
+        return self.item
+
+def is_single_item(parser):
+    return all(
+        getattr(tokenizer, 'single_item', False) and
+        not hasattr(tokenizer, 'pushes') and
+        not hasattr(tokenizer, 'pops')
+        for tokenizer in parser.tokenizers
+    )
+
+def _map_stage(parser, items):
+    stream = ItemStream()
+    parse_next = parser.parse_next
+    for item in items:
+        if item is None:
+            return
+
+        stream.reset(item)
+        yield parse_next(stream)
+
+def fuse(stages, stream, materialize=False):
+    max_lookback = getattr(stream, 'max_lookback', None)
+    items = None
+    for stage in stages:
+        if items is not None and is_single_item(stage):
+            items = _map_stage(stage, items)
+            continue
+
+        if items is not None:
+            if materialize:
+                stream = Cursor(list(it.takewhile(
+                    (lambda item: item is not None), items)))
+            else:
+                stream = ReversibleIterator(items, max_lookback)
+        items = stage._parse(stream)
+
+    return (
+        ReversibleIterator(items, max_lookback)
+        if items is not None else stream)
@@ -0,0 +1,192 @@
+import ast
+import hashlib
+import importlib.util
+import os
+import re
+import sys
+import textwrap
+
+COMPILER_VERSION = '2'
+
+header_pattern = re.compile(r'(parser|token)\s+([A-Za-z_]\w*)\s*:\s*$')
+
+def _indent(line):
+    return len(line) - len(line.lstrip(' '))
+
+def _class_name(name):
+    return ''.join(part[:1].upper() + part[1:] for part in name.split('_'))
+
+def parse_grammar(text):
+    module_lines = []
+    parsers = []
+    lines = text.split('\n')
+    i = 0
+
+    def block(lines, i, level):
+        result = []
+        while i < len(lines):
+            line = lines[i]
+            if line.strip() and _indent(line) <= level:
+                break
+            result.append(line)
+            i += 1
+        while result and not result[-1].strip():
+            result.pop()
+        return result, i
+
+    while i < len(lines):
+        line = lines[i]
+        match = header_pattern.match(line)
+        if not match or _indent(line) != 0:
+            module_lines.append(line)
+            i += 1
+            continue
+
+        if match.group(1) != 'parser':
+            raise SyntaxError(
+                'line {}: token outside of a parser block'.format(i + 1))
+
+        body, i = block(lines, i + 1, 0)
+        parser_lines = []
+        tokens = []
+        j = 0
+        while j < len(body):
+            line = body[j]
+            token_match = header_pattern.match(line.strip())
+            if token_match and token_match.group(1) == 'token':
+                token_body, end = block(body, j + 1, _indent(line))
+                j = end
+                tokens.append((
+                    token_match.group(2),
+                    textwrap.dedent('\n'.join(token_body))))
+                continue
+
+            parser_lines.append(line)
+            j += 1
+
+        parsers.append((
+            match.group(2),
+            textwrap.dedent('\n'.join(parser_lines)),
+            tokens))
+
+    return '\n'.join(module_lines), parsers
+
+class _ReturnRewriter(ast.NodeTransformer):
+    def __init__(self, name):
+        self.name = name
+
+    def visit_FunctionDef(self, node):
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+    visit_Lambda = visit_FunctionDef
+
+    def visit_Return(self, node):
+        return ast.parse(textwrap.dedent('''
+            _r_e_s_u_l_t_ = {}
+            if _r_e_s_u_l_t_:
+                stream.drop()
+            else:
+                stream.pop()
+            if _m_e_m_o_ is not None:
+                _m_e_m_o_.set(_o_f_f_s_e_t_, {}, _r_e_s_u_l_t_, stream.offset)
+            return _r_e_s_u_l_t_
+        ''').format(
+            'None' if node.value is None else ast.unparse(node.value),
+            self.name)).body
+
+def _token_source(name, body):
+    klass = _class_name(name)
+    tree = ast.parse(body or 'pass')
+    statements = []
+    for statement in tree.body:
+        statement = _ReturnRewriter(name).visit(statement)
+        statements.extend(
+            statement if isinstance(statement, list) else [statement])
+
+    falls_through = not (tree.body and isinstance(tree.body[-1], ast.Return))
+    body = ast.unparse(ast.Module(body=statements, type_ignores=[]))
+    return '\n'.join(line for line in (
+        'class {}(Token): pass'.format(klass),
+        'def {}(_s_t_r_e_a_m_=None, _s_t_a_t_e_=None, _p_u_s_h_=None, '
+        '_p_o_p_=None, **kwargs):'.format(name),
+        '    if not _s_t_r_e_a_m_:',
+        '        return {}(**kwargs)'.format(klass),
+        '    stream = _s_t_r_e_a_m_',
+        '    state = ({} if _s_t_a_t_e_ is None else _s_t_a_t_e_)',
+        '    push = _p_u_s_h_',
+        '    pop = _p_o_p_',
+        '    _m_e_m_o_ = stream.memo',
+        '    if _m_e_m_o_ is not None:',
+        '        _o_f_f_s_e_t_ = stream.offset',
+        '        _h_i_t_ = _m_e_m_o_.get(_o_f_f_s_e_t_, {})'.format(name),
+        '        if _h_i_t_ is not None:',
+        '            stream.offset = _h_i_t_[1]',
+        '            return _h_i_t_[0]',
+        '    stream.push()',
+        textwrap.indent(body, '    '),
+        '    stream.pop()' if falls_through else None,
+        '    if _m_e_m_o_ is not None:' if falls_through else None,
+        '        _m_e_m_o_.set(_o_f_f_s_e_t_, {}, None, stream.offset)'.format(
+            name) if falls_through else None,
+        '    return None' if falls_through else None,
+        '{}.token_class = {}'.format(name, klass),
+        '',
+    ) if line is not None)
+
+def compile_grammar(text, source='<grammar>'):
+    module_source, parsers = parse_grammar(text)
+    result = [
+        '# Generated from {} by grammar.py; do not edit.'.format(source),
+        'from lexer import Parser, Token',
+        module_source.strip(),
+        '',
+    ]
+
+    for name, parser_source, tokens in parsers:
+        if parser_source.strip():
+            result.extend((parser_source.strip(), ''))
+
+        for token_name, body in tokens:
+            result.append(_token_source(token_name, body))
+
+        result.extend((
+            '{} = Parser([{}])'.format(
+                name, ', '.join(token_name for token_name, _ in tokens)),
+            ''))
+
+    return '\n'.join(result)
+
+def grammar_hash(text):
+    return hashlib.sha256(
+        (COMPILER_VERSION + '\0' + text).encode('utf-8')).hexdigest()
+
+def load_grammar(path, cache_dir=None):
+    with open(path) as f:
+        text = f.read()
+
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(path)), '__lexcache__')
+
+    digest = grammar_hash(text)
+    module_name = '_grammar_{}'.format(digest[:16])
+    module_path = os.path.join(cache_dir, module_name + '.py')
+
+    if not os.path.exists(module_path):
+        source = compile_grammar(text, os.path.basename(path))
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(module_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(source)
+        os.replace(tmp_path, module_path)
+
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as f:
+        print(compile_grammar(f.read(), sys.argv[1]))
@@ -0,0 +1,333 @@
+from copy import deepcopy
+import random
+
+from lexer import (
+    CharacterParser, Filename, NewLine, Parser, PositionIndex,
+    ReversibleIterator, StringParser)
+
+# Raised by a TextSource that is not final when it runs out of text, since
+# more may still arrive.
+class Starved(Exception): pass
+
+class TextSource:
+    def __init__(self, text, offset=0, filename=None, positions=None,
+                 final=True):
+        self.text = text
+        self.position = offset
+        self.filename = filename
+        self.positions = positions
+        self.final = final
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.filename is not None:
+            result = Filename(text=self.filename, positions=self.positions)
+            self.filename = None
+            return result
+
+        position = self.position
+        if position >= len(self.text):
+            if not self.final:
+                raise Starved()
+            self.exhausted = True
+            raise StopIteration
+
+        self.position = position + 1
+        c = self.text[position]
+        return (NewLine() if c == '\n' else c)
+
+def _is_clean(stream):
+    return not (
+        stream.state_stack or
+        stream.push_back_buffer or
+        stream.iterator_history
+    )
+
+def _snapshot_state(state):
+    return {
+        k: (None if k == 'positions' else deepcopy(v))
+        for k, v in state.items()
+    }
+
+def _restore_state(state, positions):
+    result = deepcopy(state)
+    if 'positions' in result:
+        result['positions'] = positions
+    return result
+
+def _shift_state(state, delta):
+    if delta and 'offset' in state:
+        state = dict(state)
+        state['offset'] += delta
+    return state
+
+# Lexes text from offset with the given parser states (None to start a
+# file), yielding (token, position, snapshot). position is the source offset
+# when every stream is clean after the token, else None; snapshot() returns
+# the parser states there. Tokens resolve their line and column through
+# positions (by default an index of the whole text). Unless final, reaching
+# the end of text raises Starved.
+def lex_from(stages, text, offset=0, states=None, filename='<buffer>',
+             positions=None, final=True, max_lookback=None):
+    if positions is None:
+        positions = PositionIndex(text)
+    parsers = [Parser(stage.tokenizers) for stage in stages]
+    if states is not None:
+        for parser, (state, stack, restart) in zip(parsers, states):
+            parser.state = _restore_state(state, positions)
+            parser.stack = list(stack)
+            parser.restart = restart
+
+    source = TextSource(
+        text, offset, (filename if states is None else None), positions,
+        final)
+    streams = [ReversibleIterator(source, max_lookback)]
+    for parser in parsers[:-1]:
+        streams.append(parser.parse(streams[-1]))
+
+    def snapshot():
+        return tuple(
+            (_snapshot_state(parser.state), list(parser.stack),
+             parser.restart)
+            for parser in parsers)
+
+    while True:
+        token = parsers[-1].parse_next(streams[-1])
+        if token is None:
+            return
+
+        position = None
+        if (
+                not source.exhausted and
+                all(_is_clean(stream) for stream in streams)):
+            position = source.position
+
+        yield token, position, snapshot
+
+def shift_states(states, delta):
+    return tuple(
+        (_shift_state(state, delta), stack, restart)
+        for state, stack, restart in states)
+
+def states_match(new_states, old_states, delta=0):
+    return all(
+        new_state == _shift_state(old_state, delta) and
+        new_stack == old_stack and
+        new_restart == old_restart
+        for (new_state, new_stack, new_restart),
+            (old_state, old_stack, old_restart)
+        in zip(new_states, old_states))
+
+# IncrementalLexer keeps the buffer as a run of segments, each starting at a
+# clean line start, in a treap ordered by position. A segment knows its own
+# length, newline count and token count, and the parser states it starts
+# from with the Character offset rebased to 0. Token offsets are relative to
+# their segment, and the segment is the tokens' positions object: a line
+# number is the newlines in earlier segments, summed up the tree, plus the
+# line within the segment. An edit re-lexes from the segment holding its
+# start until it reaches an old segment boundary with equal states, then
+# swaps in the new segments; nothing after that point is touched.
+
+# Treap priorities, kept off the shared random module's sequence.
+_priorities = random.Random()
+
+class _Segment:
+    live = True
+
+    def __init__(self, states):
+        self.states = states
+        self.priority = _priorities.random()
+        self.left = self.right = self.parent = None
+        self.length = self.lines = self.count = 0
+        self.index = None
+        self.frozen = None
+        _update(self)
+
+    def position(self, offset):
+        line, column = self.index.position(offset)
+        lines = self.frozen
+        if lines is None:
+            lines = _lines_before(self)
+        return lines + line, column
+
+def _update(node):
+    node.size = 1
+    node.total_length = node.length
+    node.total_lines = node.lines
+    node.total_count = node.count
+    for child in (node.left, node.right):
+        if child is not None:
+            child.parent = node
+            node.size += child.size
+            node.total_length += child.total_length
+            node.total_lines += child.total_lines
+            node.total_count += child.total_count
+
+def _split(node, k):
+    # The first k segments and the rest.
+    if node is None:
+        return None, None
+
+    left_size = node.left.size if node.left is not None else 0
+    if k <= left_size:
+        left, node.left = _split(node.left, k)
+        _update(node)
+        return left, node
+
+    node.right, right = _split(node.right, k - left_size - 1)
+    _update(node)
+    return node, right
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+def _find(node, offset):
+    # The segment holding offset (the last one for the end of the text), and
+    # the segments, characters and tokens before it.
+    rank = chars = count = 0
+    while True:
+        left = node.left
+        if left is not None:
+            if offset < chars + left.total_length:
+                node = left
+                continue
+            rank += left.size
+            chars += left.total_length
+            count += left.total_count
+
+        if offset < chars + node.length or node.right is None:
+            return node, rank, chars, count
+
+        rank += 1
+        chars += node.length
+        count += node.count
+        node = node.right
+
+def _lines_before(node):
+    lines = node.left.total_lines if node.left is not None else 0
+    while node.parent is not None:
+        parent = node.parent
+        if parent.right is node:
+            lines += parent.lines
+            if parent.left is not None:
+                lines += parent.left.total_lines
+        node = parent
+    return lines
+
+def _walk(node):
+    if node is not None:
+        yield from _walk(node.left)
+        yield node
+        yield from _walk(node.right)
+
+def _rebase(states):
+    return tuple(
+        (dict(state, offset=0) if 'offset' in state else state, stack, restart)
+        for state, stack, restart in states)
+
+class IncrementalLexer:
+    def __init__(self, text, stages=None, filename='<buffer>', interval=64):
+        self.stages = (
+            [CharacterParser, StringParser] if stages is None else stages)
+        self.filename = filename
+        self.interval = interval
+        self.text = ''
+        self.tokens = []
+        self.root = _Segment(None)
+        self.edit(0, 0, text)
+
+    def _lex(self, text, offset, segment):
+        return lex_from(
+            self.stages, text, offset, segment.states, self.filename, segment)
+
+    def _close(self, segment, text, start, end, count):
+        segment.length = end - start
+        segment.lines = text.count('\n', start, end)
+        segment.count = count
+        segment.index = PositionIndex(text[start:end])
+        _update(segment)
+
+    def edit(self, start, end, replacement):
+        delta = len(replacement) - (end - start)
+        text = ''.join((self.text[:start], replacement, self.text[end:]))
+        edit_end = start + len(replacement)
+
+        old, i, base, first = _find(self.root, start)
+        segment = _Segment(old.states)
+        segments = [segment]
+        tokens = []
+        seg_start = base
+        seg_first = 0
+        resync = None
+
+        lexing = self._lex(text, base, segment)
+        while lexing is not None:
+            run, lexing = lexing, None
+            for token, offset, snapshot in run:
+                tokens.append(token)
+                if (
+                        offset is None or offset == seg_start or
+                        text[offset - 1] != '\n'):
+                    continue
+
+                if offset >= edit_end:
+                    node, j, chars, count = _find(self.root, offset - delta)
+                    if (
+                            j > i and chars == offset - delta and
+                            states_match(_rebase(snapshot()), node.states)):
+                        resync = (j, count)
+                        break
+
+                if offset - seg_start >= self.interval:
+                    # Start the next segment from here, with offsets
+                    # relative to it.
+                    self._close(
+                        segment, text, seg_start, offset,
+                        len(tokens) - seg_first)
+                    segment = _Segment(_rebase(snapshot()))
+                    segments.append(segment)
+                    seg_start = offset
+                    seg_first = len(tokens)
+                    lexing = self._lex(text, offset, segment)
+                    break
+
+        if resync is None:
+            seg_end = len(text)
+            resync = (self.root.size, self.root.total_count)
+        else:
+            seg_end = offset
+        self._close(segment, text, seg_start, seg_end, len(tokens) - seg_first)
+
+        j, last = resync
+        lines = _lines_before(old)
+        left, rest = _split(self.root, i)
+        removed, right = _split(rest, j - i)
+        # Tokens that are dropped keep reporting the lines they had.
+        for node in _walk(removed):
+            node.frozen = lines
+            lines += node.lines
+
+        middle = None
+        for segment in segments:
+            middle = _merge(middle, segment)
+        self.root = _merge(_merge(left, middle), right)
+        self.root.parent = None
+
+        self.tokens[first:last] = tokens
+        self.text = text
+        return first, last - first, tokens
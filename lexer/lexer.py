@@ -1,21 +1,41 @@
 
+from bisect import bisect_right
+from contextlib import contextmanager
 from copy import copy
-from functools import wraps
+from functools import cached_property, partial, wraps
 
 import itertools as it
 
+import os
 import re
 import sys
+import time
+
+class LookbackError(Exception): pass
+class LexError(Exception): pass
 
 class ReversibleIterator:
-    def __init__(self, iterator):
+    memo = None
+
+    def __init__(self, iterator, max_lookback=None):
         self.iterator = iter(iterator)
         self.state_stack = []
         self.push_back_buffer = []
         self.iterator_history = []
         self.iterator_history_index = 0
+        self.max_lookback = max_lookback
 
     def push(self):
+        # History before the index is unreachable once no checkpoint refers
+        # to it; in bounded mode, drop it here rather than letting replayed
+        # history pile up behind a long run of checkpoints.
+        if (
+                self.max_lookback is not None and
+                not self.state_stack and
+                self.iterator_history_index >= self.max_lookback):
+            del self.iterator_history[:self.iterator_history_index]
+            self.iterator_history_index = 0
+
         self.state_stack.append({
             'offset': self.iterator_history_index,
             'push_back_buffer': copy(self.push_back_buffer)
@@ -38,6 +58,17 @@ class ReversibleIterator:
     def put(self, obj):
         self.push_back_buffer.append(obj)
 
+    def peek(self):
+        result = self.next()
+        self.push_back_buffer.append(result)
+        return result
+
+    def rewind_distance(self):
+        state = self.state_stack[-1]
+        return (
+            self.iterator_history_index - state['offset'] +
+            len(state['push_back_buffer']) - len(self.push_back_buffer))
+
     def _clean_history(self):
         clear_history = (
             self.iterator_history_index >= len(self.iterator_history) and
@@ -69,6 +100,16 @@ class ReversibleIterator:
             return None
 
         if self.state_stack:
+            if (
+                    self.max_lookback is not None and
+                    len(self.iterator_history) -
+                    self.state_stack[0]['offset'] >= self.max_lookback):
+                self.iterator_history.append(result)
+                self.iterator_history_index += 1
+                raise LookbackError(
+                    'read more than {} items past a checkpoint'.format(
+                        self.max_lookback))
+
             self.iterator_history.append(result)
             self.iterator_history_index += 1
 
@@ -101,12 +142,239 @@ class ReversibleIterator:
     def next_until_str(self, predicate, putcap=True):
         return ''.join(self.next_until(predicate, putcap))
 
+class Cursor:
+    memo = None
+
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+        self.state_stack = []
+
+    @cached_property
+    def positions(self):
+        return PositionIndex(self.buffer)
+
+    def push(self):
+        self.state_stack.append(self.offset)
+
+    def apply(self, state=None):
+        if state is None:
+            state = self.state_stack[-1]
+
+        self.offset = state
+
+    def pop(self):
+        self.offset = self.state_stack.pop()
+
+    def drop(self):
+        self.state_stack.pop()
+
+    def rewind_distance(self):
+        return self.offset - self.state_stack[-1]
+
+    def put(self, obj):
+        if obj is None and self.offset >= len(self.buffer):
+            return
+
+        if self.offset <= 0 or self.buffer[self.offset - 1] != obj:
+            raise ValueError('Cursor can only put back the last item read')
+
+        self.offset -= 1
+
+    def peek(self):
+        offset = self.offset
+        return (self.buffer[offset] if offset < len(self.buffer) else None)
+
+    def next(self):
+        offset = self.offset
+        if offset < len(self.buffer):
+            self.offset = offset + 1
+            return self.buffer[offset]
+
+        return None
+
+    def _scan(self, predicate, putcap):
+        buffer = self.buffer
+        n = len(buffer)
+        start = i = self.offset
+        while i < n and predicate(buffer[i]):
+            i += 1
+
+        self.offset = (i if putcap or i >= n else i + 1)
+        return buffer[start:i]
+
+    def next_while(self, predicate, putcap=True):
+        return list(self._scan(predicate, putcap))
+
+    def next_until(self, predicate, putcap=True):
+        return self.next_while((lambda partial: not predicate(partial)), putcap)
+
+    def next_while_str(self, predicate, putcap=True):
+        return self._scan(predicate, putcap)
+
+    def next_until_str(self, predicate, putcap=True):
+        return self._scan((lambda partial: not predicate(partial)), putcap)
+
+class PackratMemo:
+    def __init__(self, window=0):
+        self.window = window
+        self.entries = {}
+        self.low = 0
+
+    def advance(self, offset):
+        low = offset - self.window
+        if low > self.low:
+            entries = self.entries
+            if len(entries) < low - self.low:
+                for position in [x for x in entries if x < low]:
+                    del entries[position]
+            else:
+                for position in range(self.low, low):
+                    entries.pop(position, None)
+            self.low = low
+
+    def get(self, offset, func):
+        table = self.entries.get(offset)
+        return (table.get(func) if table else None)
+
+    def set(self, offset, func, result, end):
+        if offset >= self.low:
+            self.entries.setdefault(offset, {})[func] = (result, end)
+
+profile_default = os.environ.get('LEXER_PROFILE', '') not in ('', '0')
+active_stats = None
+
+@contextmanager
+def profiling(enabled=True):
+    global profile_default
+    previous = profile_default
+    profile_default = enabled
+    try:
+        yield
+    finally:
+        profile_default = previous
+
+def tokenizer_name(tokenizer):
+    name = getattr(tokenizer, '__name__', repr(tokenizer))
+    if hasattr(tokenizer, 'keyword'):
+        name = '{}({!r})'.format(name, tokenizer.keyword)
+    return name
+
+class ParserStats:
+    def __init__(self):
+        self.tokenizers = {}
+        self.history_peak = 0
+        self.stack_peak = 0
+
+    def entry(self, tokenizer):
+        result = self.tokenizers.get(tokenizer)
+        if result is None:
+            result = self.tokenizers[tokenizer] = {
+                'attempts': 0,
+                'successes': 0,
+                'seconds': 0.0,
+                'rewound': 0,
+            }
+        return result
+
+    def sample(self, stream):
+        history = len(getattr(stream, 'iterator_history', ()))
+        if history > self.history_peak:
+            self.history_peak = history
+
+        depth = len(stream.state_stack)
+        if depth > self.stack_peak:
+            self.stack_peak = depth
+
+    def as_dict(self):
+        tokenizers = {}
+        for tokenizer, entry in self.tokenizers.items():
+            name = tokenizer_name(tokenizer)
+            key = name
+            n = 1
+            while key in tokenizers:
+                n += 1
+                key = '{}#{}'.format(name, n)
+            tokenizers[key] = dict(entry)
+
+        return {
+            'tokenizers': tokenizers,
+            'history_peak': self.history_peak,
+            'stack_peak': self.stack_peak,
+        }
+
+# Items a tokenizer can start with, or None if it could be anything.
+def first_set(tokenizer):
+    first = getattr(tokenizer, 'first', None)
+    if first is not None:
+        return frozenset(first)
+
+    substring = getattr(tokenizer, 'substring', None)
+    if substring is not None:
+        return frozenset(substring[:1])
+
+    keywords = getattr(tokenizer, 'keywords', None)
+    if keywords is not None:
+        return frozenset(keyword[:1] for keyword, _ in keywords)
+
+    charset = getattr(tokenizer, 'charset', None)
+    if charset is not None:
+        return frozenset(charset)
+
+    return None
+
+def dispatch_table(tokenizers):
+    firsts = [first_set(tokenizer) for tokenizer in tokenizers]
+    if all(first is None for first in firsts):
+        return None
+
+    keys = set()
+    for first in firsts:
+        if first is not None:
+            keys.update(first)
+
+    table = {
+        key: [
+            tokenizer
+            for tokenizer, first in zip(tokenizers, firsts)
+            if first is None or key in first
+        ]
+        for key in keys
+    }
+    default = [
+        tokenizer
+        for tokenizer, first in zip(tokenizers, firsts)
+        if first is None
+    ]
+    return table, default
+
 class Parser:
-    def __init__(self, tokenizers):
+    def __init__(self, tokenizers, packrat=False, packrat_window=0,
+                 profile=None, strict_lookback=False):
         self.tokenizers = tokenizers
         self.stack = []
         self.state = {}
         self.restart = False
+        self.packrat = packrat
+        self.packrat_window = packrat_window
+        self.profile = profile
+        self.strict_lookback = strict_lookback
+        self._stats = ParserStats()
+        self._dispatch_for = None
+        self._dispatch = None
+
+    @property
+    def stats(self):
+        return self._stats.as_dict()
+
+    def reset_stats(self):
+        self._stats = ParserStats()
+
+    def dispatch(self):
+        if self._dispatch_for is not self.tokenizers:
+            self._dispatch = dispatch_table(self.tokenizers)
+            self._dispatch_for = self.tokenizers
+        return self._dispatch
 
     def push(self, parser):
         self.stack.append(parser)
@@ -117,23 +385,82 @@ class Parser:
         self.restart = True
 
     def parse_next(self, stream):
-        tokenizers = (self.stack[-1] if self.stack else self).tokenizers
+        parser = (self.stack[-1] if self.stack else self)
+        tokenizers = parser.tokenizers
+
+        # Only try the tokenizers that can start with the next item.
+        dispatch = parser.dispatch()
+        if dispatch is not None:
+            table, default = dispatch
+            try:
+                tokenizers = table.get(stream.peek(), default)
+            except TypeError:
+                pass
+
+        if self.packrat:
+            if not hasattr(stream, 'offset'):
+                raise TypeError(
+                    'packrat mode needs an offset-addressed stream (Cursor)')
+            if stream.memo is None:
+                stream.memo = PackratMemo(self.packrat_window)
+            stream.memo.advance(stream.offset)
+
+        profile = (profile_default if self.profile is None else self.profile)
 
         for tokenizer in tokenizers:
             if self.restart:
                 self.restart = False
                 return self.parse_next(stream)
 
-            result = tokenizer(stream, self.state, self.push, self.pop)
+            depth = len(stream.state_stack)
+            stack = len(self.stack)
+            try:
+                if profile:
+                    result = self._profile_next(tokenizer, stream)
+                else:
+                    result = tokenizer(stream, self.state, self.push, self.pop)
+            except LookbackError as e:
+                # Treat the tokenizer as not matching: rewind to the
+                # checkpoint it took on entry and move on to the next one.
+                if self.strict_lookback or len(stream.state_stack) <= depth:
+                    raise LookbackError('{}: {}'.format(
+                        tokenizer_name(tokenizer), e)) from e
+
+                del stream.state_stack[depth + 1:]
+                stream.pop()
+                del self.stack[stack:]
+                self.restart = False
+                continue
+
             if result is not None:
                 return result
 
+    def _profile_next(self, tokenizer, stream):
+        global active_stats
+        stats = self._stats
+        entry = stats.entry(tokenizer)
+        previous = active_stats
+        active_stats = (stats, entry, stream, len(stream.state_stack) + 1)
+        start = time.perf_counter()
+        try:
+            result = tokenizer(stream, self.state, self.push, self.pop)
+        finally:
+            entry['seconds'] += time.perf_counter() - start
+            active_stats = previous
+
+        entry['attempts'] += 1
+        if result is not None:
+            entry['successes'] += 1
+        stats.sample(stream)
+        return result
+
     def _parse(self, stream):
         while True:
             yield self.parse_next(stream)
 
     def parse(self, stream):
-        return ReversibleIterator(self._parse(stream))
+        return ReversibleIterator(
+            self._parse(stream), getattr(stream, 'max_lookback', None))
 
 
 def stream_wrapper(klass):
@@ -151,18 +478,39 @@ def stream_wrapper(klass):
                 return func(_s_t_r_e_a_m_, _s_t_a_t_e_, _p_u_s_h_, _p_o_p_)
             else:
                 return klass(**kwargs)
+        wrapper.token_class = klass
         return wrapper
     return decorator
 
 def auto_stream(func):
     @wraps(func)
     def wrapper(_s_t_r_e_a_m_, *args, **kwds):
+        memo = _s_t_r_e_a_m_.memo
+        if memo is not None:
+            offset = _s_t_r_e_a_m_.offset
+            hit = memo.get(offset, func)
+            if hit is not None:
+                _s_t_r_e_a_m_.offset = hit[1]
+                return hit[0]
+
         _s_t_r_e_a_m_.push()
         result = func(_s_t_r_e_a_m_, *args, **kwds)
+
+        # Only the tokenizer's own outermost push on the stream it was handed
+        # is counted; nested helpers and upstream stages rewind into it.
+        if active_stats is not None and active_stats[2] is _s_t_r_e_a_m_:
+            stats, entry, _, depth = active_stats
+            stats.sample(_s_t_r_e_a_m_)
+            if not result and len(_s_t_r_e_a_m_.state_stack) == depth:
+                entry['rewound'] += _s_t_r_e_a_m_.rewind_distance()
+
         if result:
             _s_t_r_e_a_m_.drop()
         else:
             _s_t_r_e_a_m_.pop()
+
+        if memo is not None:
+            memo.set(offset, func, result, _s_t_r_e_a_m_.offset)
         return result
     return wrapper
 
@@ -183,6 +531,7 @@ def pusher(parser):
                 _p_u_s_h_(parser)
 
             return result
+        wrapper.pushes = parser
         return wrapper
     return decorator
 
@@ -204,6 +553,7 @@ def popper(func):
             _p_o_p_()
 
         return result
+    wrapper.pops = True
     return wrapper
 
 def substring_parser(substring):
@@ -218,6 +568,7 @@ def substring_parser(substring):
 
             _s_t_a_t_e_['substring'] = (substring if has_result else None)
             return func(_s_t_r_e_a_m_, _s_t_a_t_e_, *args, **kwds)
+        wrapper.substring = substring
         return wrapper
     return decorator
 
@@ -229,8 +580,60 @@ class Token:
     def __str__(self):
         return '{}: {}'.format(self.__class__.__name__, str(self.__dict__))
 
+newline_pattern = re.compile('\n')
+
+class PositionIndex:
+    def __init__(self, text=None):
+        self.text = text
+        self.length = 0
+        self._line_starts = None if text else [0]
+
+    def feed(self, chunk):
+        base = self.length
+        self.line_starts.extend(
+            base + m.end() for m in newline_pattern.finditer(chunk))
+        self.length += len(chunk)
+
+    @property
+    def line_starts(self):
+        if self._line_starts is None:
+            self._line_starts = [0]
+            self.feed(self.text)
+            self.text = None
+        return self._line_starts
+
+    def position(self, offset):
+        line_starts = self.line_starts
+        line = bisect_right(line_starts, offset)
+        return line, offset - line_starts[line - 1] + 1
+
+class position_field:
+    # Like cached_property, except that positions which can still move
+    # (those with a true `live` attribute, see incremental.py) are looked up
+    # again on every access.
+    def __init__(self, index):
+        self.index = index
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, token, owner=None):
+        if token is None:
+            return self
+
+        positions = token.positions
+        value = positions.position(token.offset)[self.index]
+        if not getattr(positions, 'live', False):
+            token.__dict__[self.name] = value
+        return value
+
+class PositionedToken(Token):
+    line = position_field(0)
+    column = position_field(1)
+
 def identity(stream, state, push, pop):
     return stream.next()
+identity.single_item = True
 
 class CarriageReturn(Token): pass
 @stream_wrapper(CarriageReturn)
@@ -291,6 +694,8 @@ def identifier(stream, state, push, pop):
         if text and not (ord_0 <= ord_t0 and ord_t0 <= ord_9)
         else None
     )
+identifier.charset = frozenset(
+    'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_')
 
 class Colon(Token): pass
 @stream_wrapper(Colon)
@@ -311,35 +716,176 @@ def keyword_parser(keyword, klass):
             stream.pop()
             return (klass() if not id else None)
         return None
+    keyword_func.keyword = keyword
     return keyword_func
 
+def keyword_set_parser(keywords):
+    keywords = list(keywords)
+    charset = identifier.charset
+    table = {}
+    trie = {}
+    for priority, (keyword, klass) in enumerate(keywords):
+        table.setdefault(keyword, klass)
+        node = trie
+        for c in keyword:
+            node = node.setdefault(c, {})
+        node.setdefault(None, (priority, keyword, klass))
+
+    if all(c in charset for keyword, _ in keywords for c in keyword):
+        @auto_stream
+        def keyword_set(stream, state, push, pop):
+            text = stream.next_while_str((lambda c: c in charset))
+            klass = table.get(text)
+            state['substring'] = (text if klass else None)
+            return (klass() if klass else None)
+    else:
+        @auto_stream
+        def keyword_set(stream, state, push, pop):
+            read = []
+            found = []
+            node = trie
+            while True:
+                if None in node:
+                    found.append((node[None], len(read)))
+
+                c = stream.next()
+                if c is None:
+                    break
+
+                read.append(c)
+                node = node.get(c)
+                if node is None:
+                    break
+
+            best = None
+            for candidate, n in found:
+                follow = (read[n] if n < len(read) else None)
+                if follow in charset:
+                    continue
+                if best is None or candidate[0] < best[0][0]:
+                    best = (candidate, n)
+
+            if best is None:
+                state['substring'] = None
+                return None
+
+            (_, keyword, klass), n = best
+            for c in reversed(read[n:]):
+                stream.put(c)
+
+            state['substring'] = keyword
+            return klass()
+
+    keyword_set.keywords = keywords
+    return keyword_set
+
+def merge_keywords(tokenizers):
+    result = []
+    run = []
+    for tokenizer in list(tokenizers) + [None]:
+        mergeable = (
+            tokenizer is not None and
+            hasattr(tokenizer, 'keyword') and
+            not hasattr(tokenizer, 'pushes') and
+            not hasattr(tokenizer, 'pops')
+        )
+        if mergeable:
+            run.append(tokenizer)
+            continue
+
+        if len(run) > 1:
+            result.append(keyword_set_parser(
+                (t.keyword, t.token_class) for t in run))
+        else:
+            result.extend(run)
+        run = []
+
+        if tokenizer is not None:
+            result.append(tokenizer)
+
+    return result
+
 class ParserKeyword(Token): pass
 
-class Filename(Token): pass
+def normalize_newlines(chunks):
+    carriage_return = False
+    for chunk in chunks:
+        if carriage_return:
+            chunk = '\r' + chunk
+
+        carriage_return = chunk.endswith('\r')
+        if carriage_return:
+            chunk = chunk[:-1]
+
+        if chunk:
+            yield chunk.replace('\r\n', '\n').replace('\r', '\n')
+
+    if carriage_return:
+        yield '\n'
+
+class FileSource:
+    def __init__(self, fname, chunk_size=1 << 16):
+        self.fname = fname
+        self.chunk_size = chunk_size
+        self.positions = PositionIndex()
+
+    def _read(self):
+        with open(self.fname, newline='') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def __iter__(self):
+        for chunk in normalize_newlines(self._read()):
+            self.positions.feed(chunk)
+            yield chunk
+
+    def read(self):
+        return ''.join(self)
+
+class Filename(Token):
+    def __str__(self):
+        return '{}: {}'.format(
+            self.__class__.__name__, str({'text': self.text}))
+
 class NewLine(Token): pass
 @stream_wrapper(Filename)
 def filename(stream, state, push, pop):
-    if 'f' in state:
-        result = '\r'
-        while result == '\r':
-            result = state['f'].read(1)
-
-        if result:
+    if 'chunks' in state:
+        chunk = state['chunk']
+        index = state['index']
+        while chunk is not None and index >= len(chunk):
+            chunk = next(state['chunks'], None)
+            index = 0
+
+        if chunk is not None:
+            state['chunk'] = chunk
+            state['index'] = index + 1
+            result = chunk[index]
             if result == '\n':
                 result = NewLine()
             return result
 
-        del state['f']
+        del state['chunks']
 
     fname = stream.next()
 
     if fname:
-        state['f'] = open(fname)
-        return filename(text=fname)
+        source = FileSource(fname)
+        state['chunks'] = iter(source)
+        state['chunk'] = ''
+        state['index'] = 0
+        return filename(text=fname, positions=source.positions)
 
     return None
 
-class Character(Token): pass
+class Character(PositionedToken):
+    def __str__(self):
+        return '{}: {}'.format(self.__class__.__name__, str({
+            'c': self.c, 'line': self.line, 'column': self.column}))
+
 @stream_wrapper(Character)
 @auto_stream
 def character(stream, state, push, pop):
@@ -347,148 +893,222 @@ def character(stream, state, push, pop):
 
     if isinstance(c, Filename):
         state['filename'] = c.text
-        state['line_number'] = 1
-        state['column_number'] = 1
+        state['positions'] = c.positions
+        state['offset'] = 0
 
         return None
 
     if isinstance(c, NewLine):
-        state['line_number'] += 1
-        state['column_number'] = 1
+        state['offset'] += 1
 
         return None
 
     result = None
     if c is not None:
         result = character(
-            c=c, line=state['line_number'], column=state['column_number'])
+            c=c, offset=state['offset'], positions=state['positions'])
 
-        state['column_number'] += 1
+        state['offset'] += 1
 
     return result
+character.single_item = True
+
+quotes = '"\'`'
+hex_digits = '0-9a-fA-F'
+
+# Whole literals, for streams over raw text: jump from one quote or
+# backslash to the next instead of stepping through characters.
+string_patterns = {
+    q: re.compile(r'{0}((?:[^{0}\\]|\\.)*){0}'.format(re.escape(q)), re.S)
+    for q in quotes
+}
+
+# A backslash not followed by a valid escape leaves group 1 unset.
+escape_patterns = {
+    q: re.compile(r'\\([abfnrtv\\{0}]|x[{1}]{{2}}|u[{1}]{{4}})?'.format(
+        re.escape(q), hex_digits))
+    for q in quotes
+}
+
+escape_values = {
+    'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+    'v': '\v',
+}
+
+class String(PositionedToken):
+    # Holds the literal's raw contents in `text`; the per-character tokens
+    # and the decoded value are only built when asked for.
+    @cached_property
+    def tokens(self):
+        text = self.text
+        offset = self.offset + 1
+        positions = self.positions
+        result = []
+        i = 0
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if c == '\\':
+                c2 = text[i + 1]
+                k = (3 if c2 == 'x' else 5 if c2 == 'u' else 1)
+                result.append(EscapeSequence(text=text[i + 1:i + 1 + k]))
+                i += k + 1
+                continue
+
+            if c == '\n':
+                result.append(NewLine())
+            else:
+                result.append(Character(
+                    c=c, offset=offset + i, positions=positions))
+            i += 1
+
+        return result
+
+    @cached_property
+    def value(self):
+        result = []
+        for token in self.tokens:
+            if isinstance(token, Character):
+                result.append(token.c)
+            elif isinstance(token, NewLine):
+                result.append('\n')
+            elif token.text[0] in 'xu' and len(token.text) > 1:
+                result.append(chr(int(token.text[1:], 16)))
+            else:
+                result.append(escape_values.get(token.text, token.text))
+        return ''.join(result)
 
-class String(Token):
     def __str__(self):
         return ''.join((
             'STR ', '(', self.char, ') ',
             '[', ' '.join(str(t) for t in self.tokens), ']'))
 
 class EscapeSequence(Token): pass
+
+def make_string(offset, positions, char, text):
+    if '\\' in text:
+        for match in escape_patterns[char].finditer(text):
+            if match.group(1) is None:
+                raise LexError('Invalid escape sequence')
+    return String(offset=offset, positions=positions, char=char, text=text)
+
+def _scan_string(stream, buffer):
+    offset = stream.offset
+    pattern = string_patterns.get(buffer[offset:offset + 1])
+    if pattern is None:
+        return None
+
+    match = pattern.match(buffer, offset)
+    if match is None:
+        return None
+
+    stream.offset = match.end()
+    return make_string(
+        offset, stream.positions, buffer[offset], match.group(1))
+
 @stream_wrapper(String)
 @auto_stream
 def string(stream, state, push, pop):
-    c = stream.next()
-    if isinstance(c, Character) and c.c in '"\'`':
-        tokens = []
-        head = c
-        escape = None
+    buffer = getattr(stream, 'buffer', None)
+    if isinstance(buffer, str):
+        return _scan_string(stream, buffer)
 
-        while True:
-            c = stream.next()
-            if escape == 'x':
-                c2 = stream.next()
-                if (
-                        isinstance(c, Character) and
-                        isinstance(c2, Chaacter) and (
-                        (ord('a') <= ord(c.c) and ord(c.c) <= ord('f')) or
-                        (ord('A') <= ord(c.c) and ord(c.c) <= ord('F')) or
-                        (ord('0') <= ord(c.c) and ord(c.c) <= ord('9'))) and (
-                        (ord('a') <= ord(c2.c) and ord(c2.c) <= ord('f')) or
-                        (ord('A') <= ord(c2.c) and ord(c2.c) <= ord('F')) or
-                        (ord('0') <= ord(c2.c) and ord(c2.c) <= ord('9')))):
-                    tokens.append(EscapeSequence(
-                            text=''.join(('x', c.c, c2.c))))
-                    escape = None
-                else:
-                    raise Error('Invalid escape sequence')
-            elif escape == 'u':
-                c2 = stream.next()
-                c3 = stream.next()
-                c4 = stream.next()
-                if (
-                        isinstance(c, Character) and
-                        isinstance(c2, Chaacter) and
-                        isinstance(c3, Chaacter) and
-                        isinstance(c4, Chaacter) and (
-                        (ord('a') <= ord(c.c) and ord(c.c) <= ord('f')) or
-                        (ord('A') <= ord(c.c) and ord(c.c) <= ord('F')) or
-                        (ord('0') <= ord(c.c) and ord(c.c) <= ord('9'))) and (
-                        (ord('a') <= ord(c2.c) and ord(c2.c) <= ord('f')) or
-                        (ord('A') <= ord(c2.c) and ord(c2.c) <= ord('F')) or
-                        (ord('0') <= ord(c2.c) and ord(c2.c) <= ord('9'))) and (
-                        (ord('a') <= ord(c3.c) and ord(c3.c) <= ord('f')) or
-                        (ord('A') <= ord(c3.c) and ord(c3.c) <= ord('F')) or
-                        (ord('0') <= ord(c3.c) and ord(c3.c) <= ord('9'))) and (
-                        (ord('a') <= ord(c4.c) and ord(c4.c) <= ord('f')) or
-                        (ord('A') <= ord(c4.c) and ord(c4.c) <= ord('F')) or
-                        (ord('0') <= ord(c4.c) and ord(c4.c) <= ord('9')))):
-                    tokens.append(EscapeSequence(
-                            text=''.join(('u', c.c, c2.c, c3.c, c4.c))))
-                    escape = None
-                else:
-                    raise Error('Invalid escape sequence')
-            else:
-                if isinstance(c, Character):
-                    if c.c == head.c:
-                        return String(
-                                column=head.column,
-                                line=head.line,
-                                char=head.c,
-                                tokens=tokens)
-                    elif c.c == '\\':
-                        c2 = stream.next()
-                        if isinstance(c2, Character):
-                            if c2.c in 'abfnrtv\\' or c2.c == head.c:
-                                tokens.append(EscapeSequence(text=c2.c))
-                            elif c2.c == 'x' or c2.c == 'u':
-                                escape = c2.c
-                            else:
-                                raise Error('Invalid escape sequence')
-                        else:
-                            raise Error('Invalid escape sequence')
-                    else:
-                        tokens.append(c)
-                else:
-                    tokens.append(c)
+    head = stream.next()
+    if not (isinstance(head, Character) and head.c in quotes):
+        return None
 
-    return None
+    text = []
+    escape = False
+    while True:
+        c = stream.next()
+        if isinstance(c, Character):
+            if not escape and c.c == head.c:
+                return make_string(
+                    head.offset, head.positions, head.c, ''.join(text))
+            escape = (not escape and c.c == '\\')
+            text.append(c.c)
+        elif isinstance(c, NewLine):
+            escape = False
+            text.append('\n')
+        else:
+            # End of input (or of the file) before the closing quote.
+            return None
 
 class Indent(Token): pass
+class Dedent(Token): pass
+
+def is_blank(c):
+    return isinstance(c, Character) and (c.c == ' ' or c.c == '\t')
+
+def indent_width(run):
+    width = 0
+    for c in run:
+        width = ((width//8 + 1)*8 if c.c == '\t' else width + 1)
+    return width
+
+def _indent_tokens(state, width):
+    levels = state['levels']
+    tokens = []
+    while width < levels[-1]:
+        levels.pop()
+        tokens.append(Dedent(width=levels[-1]))
+
+    if width > levels[-1]:
+        levels.append(width)
+        tokens.append(Indent(width=width))
+
+    if not tokens:
+        return None
+
+    tokens.reverse()
+    result = tokens.pop()
+    state['pending'] = tokens
+    return result
+
+# Passes every item through, adding Indent/Dedent tokens ahead of the first
+# item of a line whose leading whitespace changes the indentation level.
+# Blank lines leave the level alone; the end of input (or the next file)
+# closes every open level.
 @stream_wrapper(Indent)
-@auto_stream
 def indent(stream, state, push, pop):
-    state['indent_enabled'] = state.get('indent_enabled', True)
-    indent_enabled = state['indent_enabled']
+    pending = state.get('pending')
+    if pending:
+        return pending.pop()
+
+    if 'levels' not in state:
+        state['levels'] = [0]
+        state['line_start'] = True
+
+    if state['line_start']:
+        state['line_start'] = False
+        stream.push()
+        run = stream.next_while(is_blank)
+        cap = stream.next()
+        stream.pop()
+
+        if isinstance(cap, NewLine):
+            width = state['levels'][-1]
+        elif cap is None or isinstance(cap, Filename):
+            width = 0
+        else:
+            width = indent_width(run)
 
-    c = stream.next()
+        result = _indent_tokens(state, width)
+        if result is not None:
+            return result
 
-    if indent_enabled:
-        predicate = lambda x: isinstance(x, Character) and x.c == ' '
-        if predicate(c) and (c.column - 1)%4 == 0:
-            stream.push()
-            if (
-                predicate(stream.next()) and
-                predicate(stream.next()) and
-                predicate(stream.next())
-            ):
-                stream.drop()
-                return Indent(column=c.column)
-            else:
-                stream.pop()
+    c = stream.next()
+    if c is None:
+        return _indent_tokens(state, 0)
 
-    state['indent_enabled'] = isinstance(c, NewLine)
-    return None
+    if isinstance(c, (NewLine, Filename)):
+        state['line_start'] = True
+    return c
 
 FilenameParser = Parser([filename])
 CharacterParser = Parser([character, identity])
 StringParser = Parser([string, identity])
-IndentParser = Parser([indent, identity])
-
-streams = [ReversibleIterator(('sample.txt',))]
-streams.append(FilenameParser.parse(streams[-1]))
-streams.append(CharacterParser.parse(streams[-1]))
-streams.append(StringParser.parse(streams[-1]))
-# streams.append(IndentParser.parse(streams[-1]))
+IndentParser = Parser([indent])
 
 ## ParserKeywordSubParser = Parser([
 ##     space,
@@ -510,8 +1130,73 @@ streams.append(StringParser.parse(streams[-1]))
 ## 
 ## S2 = MainParser.parse(S)
 
-while True:
-    token = streams[-1].next()
-    if token is None: break
-    print('[' + str(token) + ']')
-
+def pipeline(stream):
+    streams = [stream]
+    for stage in (FilenameParser, CharacterParser, StringParser):
+        streams.append(Parser(stage.tokenizers).parse(streams[-1]))
+    return streams[-1]
+
+def lex_file(fname, max_lookback=None, cache_dir=None):
+    try:
+        if cache_dir is not None:
+            from tokenfile import LexCache
+            tokens = LexCache(cache_dir, max_lookback=max_lookback).tokens(
+                fname)
+            return fname, ['[' + str(token) + ']' for token in tokens], None
+
+        stream = pipeline(ReversibleIterator((fname,), max_lookback))
+        lines = []
+        while True:
+            token = stream.next()
+            if token is None: break
+            lines.append('[' + str(token) + ']')
+        return fname, lines, None
+    except Exception as e:
+        return fname, None, '{}: {}'.format(e.__class__.__name__, e)
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = ArgumentParser()
+    parser.add_argument('files', nargs='*', default=['sample.txt'],
+                        help="files to lex ('-' reads file names from stdin)")
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=16)
+    parser.add_argument('--max-lookback', type=int, default=None,
+                        help='bound the items a tokenizer may read ahead')
+    parser.add_argument('--cache', default=None, metavar='DIR',
+                        help='reuse token files for unchanged inputs')
+    args = parser.parse_args(argv)
+
+    files = args.files
+    if files == ['-']:
+        files = (line.rstrip('\n') for line in sys.stdin if line.strip())
+
+    lex = partial(
+        lex_file, max_lookback=args.max_lookback, cache_dir=args.cache)
+    status = 0
+    executor = None
+    if args.jobs == 1:
+        results = map(lex, files)
+    else:
+        executor = ProcessPoolExecutor(args.jobs)
+        results = executor.map(lex, files, chunksize=args.chunksize)
+
+    try:
+        for fname, lines, error in results:
+            if error is not None:
+                print('{}: {}'.format(fname, error), file=sys.stderr)
+                status = 1
+                continue
+
+            for line in lines:
+                print(line)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
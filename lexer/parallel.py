@@ -0,0 +1,178 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from lexer import CharacterParser, FileSource, PositionIndex, StringParser
+from incremental import lex_from, shift_states, states_match
+
+# A file is cut at newlines into chunks that are lexed side by side. Every
+# chunk but the first starts from a guess: the parser states at the top of
+# the file, moved to the chunk's offset, which is right unless the chunk
+# starts inside something like a String. Each chunk keeps a checkpoint at
+# every clean line start it reaches. Stitching walks the chunks in order and
+# takes a chunk's tokens from the checkpoint where the previous chunk
+# stopped, provided the real states match the checkpoint's. Lexing from
+# equal states at the same offset gives the same tokens, so the result is
+# the sequential output; chunks without a matching checkpoint are lexed
+# again from the real states.
+
+_text = None
+_fname = None
+_stages = None
+
+def _read(fname):
+    return FileSource(fname).read()
+
+def _init(fname, stages):
+    global _text, _fname, _stages
+    _text = _read(fname)
+    _fname = fname
+    _stages = stages
+
+def _detach(tokens):
+    for token in tokens:
+        attrs = getattr(token, '__dict__', None)
+        if not attrs:
+            continue
+        if 'positions' in attrs:
+            token.positions = None
+        if 'tokens' in attrs:
+            _detach(token.tokens)
+
+def _attach(tokens, positions):
+    for token in tokens:
+        attrs = getattr(token, '__dict__', None)
+        if not attrs:
+            continue
+        if 'positions' in attrs:
+            token.positions = positions
+        if 'tokens' in attrs:
+            _attach(token.tokens, positions)
+
+# Lexes from start up to the first clean line start at or after stop,
+# keeping checkpoints at the first max_checkpoints clean line starts.
+def lex_range(stages, text, fname, start, stop, states, max_checkpoints=256):
+    tokens = []
+    offsets = []
+    counts = []
+    checkpoints = []
+    end = len(text)
+    end_states = None
+
+    for token, position, snapshot in lex_from(
+            stages, text, start, states, fname):
+        tokens.append(token)
+        if position is None or position <= start or (
+                text[position - 1] != '\n'):
+            continue
+
+        if position >= stop:
+            end = position
+            end_states = snapshot()
+            break
+
+        if len(offsets) < max_checkpoints:
+            offsets.append(position)
+            counts.append(len(tokens))
+            checkpoints.append(snapshot())
+
+    return {
+        'start': start,
+        'tokens': tokens,
+        'offsets': offsets,
+        'counts': counts,
+        'checkpoints': checkpoints,
+        'end': end,
+        'end_states': end_states,
+    }
+
+def _lex_chunk(args):
+    start, stop, states = args
+    result = lex_range(_stages, _text, _fname, start, stop, states)
+    _detach(result['tokens'])
+    return result
+
+# Parser states at offset 0, after the file's Filename token.
+def top_states(stages, text, fname):
+    for token, position, snapshot in lex_from(stages, text, 0, None, fname):
+        if position == 0:
+            return snapshot()
+        break
+    raise ValueError('no clean position at the start of the file')
+
+def split(text, chunk_size):
+    bounds = [0]
+    while bounds[-1] + chunk_size < len(text):
+        cut = text.find('\n', bounds[-1] + chunk_size)
+        if cut < 0:
+            break
+        bounds.append(cut + 1)
+    bounds.append(len(text))
+    return list(zip(bounds, bounds[1:]))
+
+# Returns the tokens and the number of chunks that had to be lexed again.
+def lex_parallel(fname, jobs=None, chunk_size=1 << 20, stages=None):
+    if stages is None:
+        stages = [CharacterParser, StringParser]
+
+    text = _read(fname)
+    chunks = split(text, chunk_size)
+    top = top_states(stages, text, fname)
+    tasks = [(0, chunks[0][1], None)] + [
+        (start, stop, shift_states(top, start)) for start, stop in chunks[1:]]
+
+    with ProcessPoolExecutor(
+            jobs, initializer=_init, initargs=(fname, stages)) as executor:
+        results = list(executor.map(_lex_chunk, tasks))
+
+    tokens = []
+    position = 0
+    states = None
+    relexed = 0
+    for i, ((start, stop), result) in enumerate(zip(chunks, results)):
+        if i and position >= stop:
+            # An earlier chunk's last token ran past all of this one. The
+            # first chunk always counts, even when empty: it holds the
+            # Filename token.
+            continue
+
+        resume = None
+        if position == start and states is None:
+            resume = 0
+        elif position == start and states_match(
+                states, shift_states(top, start)):
+            resume = 0
+        else:
+            for offset, count, checkpoint in zip(
+                    result['offsets'], result['counts'],
+                    result['checkpoints']):
+                if offset == position and states_match(states, checkpoint):
+                    resume = count
+                    break
+
+        if resume is None:
+            relexed += 1
+            result = lex_range(stages, text, fname, position, stop, states)
+            _detach(result['tokens'])
+            resume = 0
+
+        tokens.extend(result['tokens'][resume:])
+        position = result['end']
+        states = result['end_states']
+
+    _attach(tokens, PositionIndex(text))
+    return tokens, relexed
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=1 << 20)
+    args = parser.parse_args(argv)
+
+    tokens, _ = lex_parallel(args.file, args.jobs, args.chunk_size)
+    for token in tokens:
+        print('[' + str(token) + ']')
+
+if __name__ == '__main__':
+    main()
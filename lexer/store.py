@@ -0,0 +1,146 @@
+from array import array
+import itertools as it
+
+from lexer import Character, Filename, NewLine, PositionedToken
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class TokenStore:
+    def __init__(self, text=None):
+        self.text = text
+        self.kinds = []
+        self.text_attrs = []
+        # Whether views of a kind get line/column, as only PositionedTokens
+        # carry them.
+        self.positioned = []
+        self.kind_ids = {}
+        self.kind = array('H')
+        self.start = array('I')
+        self.end = array('I')
+        self.line = array('I')
+        self.column = array('I')
+        self.attrs = {}
+
+    def kind_id(self, klass, text_attr=None):
+        key = (klass, text_attr)
+        result = self.kind_ids.get(key)
+        if result is None:
+            result = len(self.kinds)
+            self.kind_ids[key] = result
+            self.kinds.append(klass)
+            self.text_attrs.append(text_attr)
+            self.positioned.append(
+                klass is not str and issubclass(klass, PositionedToken))
+        return result
+
+    def append(self, kind, start, end, line=0, column=0, attrs=None):
+        if attrs:
+            self.attrs[len(self.kind)] = attrs
+        self.kind.append(kind)
+        self.start.append(start)
+        self.end.append(end)
+        self.line.append(line)
+        self.column.append(column)
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        kind = self.kind[index]
+        klass = self.kinds[kind]
+        start = self.start[index]
+        end = self.end[index]
+
+        if klass is str:
+            return self.text[start:end]
+
+        token = klass.__new__(klass)
+        text_attr = self.text_attrs[kind]
+        if text_attr:
+            setattr(token, text_attr, self.text[start:end])
+
+        if self.positioned[kind]:
+            token.line = self.line[index]
+            token.column = self.column[index]
+
+        attrs = self.attrs.get(index)
+        if attrs:
+            token.__dict__.update(attrs)
+
+        return token
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def columns(self):
+        result = {
+            'kind': self.kind,
+            'start': self.start,
+            'end': self.end,
+            'line': self.line,
+            'column': self.column,
+        }
+
+        if numpy is not None:
+            result = {
+                k: numpy.frombuffer(v, dtype=v.typecode)
+                for k, v in result.items()
+            }
+
+        return result
+
+def scan_to_store(scanner, text, pos=0):
+    store = TokenStore(text)
+    kinds = [
+        store.kind_id(rule.token_class, ('text' if rule.charset else None))
+        for rule in scanner.rules
+    ]
+    raw = store.kind_id(str)
+
+    line = 1
+    line_start = 0
+    last = 0
+    for index, start, end in scanner.scan_spans(text, pos):
+        if text.count('\n', last, start):
+            line += text.count('\n', last, start)
+            line_start = text.rfind('\n', last, start) + 1
+        last = start
+
+        store.append(
+            (raw if index is None else kinds[index]),
+            start, end, line, start - line_start + 1)
+
+    return store
+
+def store_characters(text, fname=None):
+    store = TokenStore(text)
+    character = store.kind_id(Character, 'c')
+    newline = store.kind_id(NewLine)
+    if fname is not None:
+        store.append(store.kind_id(Filename), 0, 0, attrs={'text': fname})
+
+    offset = 0
+    for line_number, line in enumerate(text.split('\n'), 1):
+        n = len(line)
+        store.kind.extend(it.repeat(character, n))
+        store.start.extend(range(offset, offset + n))
+        store.end.extend(range(offset + 1, offset + n + 1))
+        store.line.extend(it.repeat(line_number, n))
+        store.column.extend(range(1, n + 1))
+        offset += n
+
+        if offset < len(text):
+            store.append(newline, offset, offset + 1, line_number, n + 1)
+            offset += 1
+
+    return store
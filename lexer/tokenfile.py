@@ -0,0 +1,358 @@
+from array import array
+from functools import cached_property
+import hashlib
+import json
+import locale
+import mmap
+import os
+import struct
+import sys
+
+import lexer
+from lexer import (
+    CharacterParser, Parser, PositionedToken, PositionIndex,
+    ReversibleIterator, StringParser, Token, normalize_newlines)
+from incremental import TextSource
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Layout of a token file:
+#
+#   header    magic, format version, byte order
+#   records   one (kind, start, end, line, column) uint32 record per token,
+#             in native byte order so the reader can cast them in place
+#   footer    JSON kind table, attribute side-table and record count
+#   trailer   footer offset and magic again
+#
+# start/end index the newline-normalized source text, which the reader is
+# handed back; token text that is a slice of it is not stored again. A kind
+# is (class name, text attribute, flags, lead): the text attribute is
+# text[start + lead:end]; a plain str item either is such a span (kind
+# ('str', 'value', 0, 0)) or has its value in the side-table. Class names resolve against token_classes, so
+# register() any Token subclass defined outside lexer.py. Attributes cached
+# from others (such as String.tokens) are not stored but rebuilt on demand.
+
+FORMAT_VERSION = 2
+MAGIC = b'LXTK'
+header = struct.Struct('<4sBB2x')
+trailer = struct.Struct('<Q4s')
+FIELDS = 5
+
+HAS_OFFSET = 1
+HAS_POSITION = 2
+
+class TokenFileError(ValueError): pass
+
+token_classes = {'str': str}
+token_classes.update(
+    (v.__name__, v) for v in vars(lexer).values()
+    if isinstance(v, type) and issubclass(v, Token))
+
+def register(klass):
+    token_classes[klass.__name__] = klass
+    return klass
+
+def _check_registered(klass):
+    if klass.__name__ not in token_classes:
+        raise TokenFileError('unregistered token class {}'.format(
+            klass.__name__))
+
+def _stored_attrs(token, attrs):
+    result = {}
+    klass = token.__class__
+    for k, v in attrs.items():
+        if isinstance(getattr(klass, k, None), cached_property):
+            continue
+        if isinstance(v, Token) or (
+                isinstance(v, (list, tuple)) and
+                any(isinstance(x, Token) for x in v)):
+            raise TokenFileError('cannot store nested tokens in {}.{}'.format(
+                klass.__name__, k))
+        result[k] = v
+    return result
+
+class TokenWriter:
+    def __init__(self, f, text=None, buffer_size=4096):
+        self.f = f
+        self.text = text
+        self.buffer_size = buffer_size
+        self.kinds = []
+        self.kind_ids = {}
+        self.attrs = {}
+        self.count = 0
+        self.records = array('I')
+        f.write(header.pack(
+            MAGIC, FORMAT_VERSION, (sys.byteorder == 'little')))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+
+    def kind_id(self, klass, text_attr=None, flags=0, lead=0):
+        key = (klass.__name__, text_attr, flags, lead)
+        result = self.kind_ids.get(key)
+        if result is None:
+            result = len(self.kinds)
+            self.kind_ids[key] = result
+            self.kinds.append(key)
+        return result
+
+    def append(self, kind, start, end, line=0, column=0, attrs=None):
+        if attrs:
+            self.attrs[self.count] = attrs
+        self.records.extend((kind, start, end, line, column))
+        self.count += 1
+        if len(self.records) >= self.buffer_size * FIELDS:
+            self.flush()
+
+    def write(self, token):
+        if not isinstance(token, Token):
+            self.append(self.kind_id(str), 0, 0, attrs={'value': token})
+            return
+
+        _check_registered(token.__class__)
+
+        attrs = dict(token.__dict__)
+        for k in ('positions', 'line', 'column'):
+            attrs.pop(k, None)
+
+        flags = 0
+        start = end = line = column = 0
+        text_attr = None
+        lead = 0
+
+        offset = attrs.pop('offset', None)
+        if offset is not None:
+            flags |= HAS_OFFSET
+            start = end = offset
+            text = self.text
+            if text is not None:
+                # The longest attribute found in the text at the token's
+                # offset, or just after it (a String's contents).
+                for k, v in attrs.items():
+                    if not isinstance(v, str) or len(v) <= end - start - lead:
+                        continue
+                    for skip in (0, 1):
+                        if text.startswith(v, offset + skip):
+                            text_attr = k
+                            lead = skip
+                            end = offset + skip + len(v)
+                            break
+                if text_attr is not None:
+                    del attrs[text_attr]
+
+        if isinstance(token, PositionedToken):
+            flags |= HAS_POSITION
+            line = token.line
+            column = token.column
+
+        self.append(
+            self.kind_id(token.__class__, text_attr, flags, lead),
+            start, end, line, column, _stored_attrs(token, attrs))
+
+    def write_store(self, store):
+        for klass in store.kinds:
+            _check_registered(klass)
+        kinds = [
+            self.kind_id(str, 'value') if klass is str else
+            self.kind_id(klass, text_attr, (HAS_POSITION if positioned else 0))
+            for klass, text_attr, positioned in zip(
+                store.kinds, store.text_attrs, store.positioned)
+        ]
+        for i in range(len(store)):
+            self.append(
+                kinds[store.kind[i]], store.start[i], store.end[i],
+                store.line[i], store.column[i], store.attrs.get(i))
+
+    def flush(self):
+        self.f.write(self.records.tobytes())
+        self.records = array('I')
+
+    def close(self):
+        self.flush()
+        position = self.f.tell()
+        self.f.write(json.dumps({
+            'count': self.count,
+            'kinds': self.kinds,
+            'attrs': sorted(self.attrs.items()),
+        }).encode())
+        self.f.write(trailer.pack(position, MAGIC))
+
+# Read-only view of a token file; records are read in place.
+class TokenFile:
+    def __init__(self, buffer, text=None):
+        self.buffer = buffer
+        self.text = text
+        # For attributes worked out lazily from the token's position, such
+        # as String.tokens.
+        self.positions = (None if text is None else PositionIndex(text))
+        view = memoryview(buffer)
+
+        magic, version, little = header.unpack_from(view, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise TokenFileError('not a version {} token file'.format(
+                FORMAT_VERSION))
+        if bool(little) != (sys.byteorder == 'little'):
+            raise TokenFileError('token file has foreign byte order')
+
+        position, magic = trailer.unpack_from(view, len(view) - trailer.size)
+        if magic != MAGIC:
+            raise TokenFileError('truncated token file')
+
+        try:
+            footer = json.loads(bytes(view[position:len(view) - trailer.size]))
+            self.kinds = [
+                (token_classes[name], text_attr, flags, lead)
+                for name, text_attr, flags, lead in footer['kinds']]
+            self.attrs = {index: attrs for index, attrs in footer['attrs']}
+            count = footer['count']
+        except KeyError as e:
+            raise TokenFileError('unknown token kind {}'.format(e))
+        except (TypeError, ValueError):
+            raise TokenFileError('malformed token file footer')
+        if text is None and any(kind[1] for kind in self.kinds):
+            raise TokenFileError(
+                'token file keeps token text as spans of the source; '
+                'pass the source text')
+
+        self.records = view[header.size:position].cast('I')
+        if len(self.records) != count * FIELDS:
+            raise TokenFileError('token file record count mismatch')
+
+    def __len__(self):
+        return len(self.records) // FIELDS
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+
+        base = index * FIELDS
+        kind, start, end, line, column = self.records[base:base + FIELDS]
+        klass, text_attr, flags, lead = self.kinds[kind]
+        attrs = self.attrs.get(index)
+
+        if klass is str:
+            return (self.text[start:end] if text_attr else attrs['value'])
+
+        token = klass.__new__(klass)
+        if flags & HAS_OFFSET:
+            token.offset = start
+        if text_attr:
+            setattr(token, text_attr, self.text[start + lead:end])
+        if flags & HAS_POSITION:
+            token.line = line
+            token.column = column
+            if self.positions is not None:
+                token.positions = self.positions
+        if attrs:
+            token.__dict__.update(attrs)
+
+        return token
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def columns(self):
+        if numpy is not None:
+            table = numpy.frombuffer(
+                self.records, dtype=numpy.uint32).reshape(-1, FIELDS)
+            columns = table.T
+        else:
+            columns = [self.records[i::FIELDS] for i in range(FIELDS)]
+
+        return dict(zip(('kind', 'start', 'end', 'line', 'column'), columns))
+
+def write_tokens(path, tokens, text=None):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            with TokenWriter(f, text) as writer:
+                for token in tokens:
+                    writer.write(token)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_tokens(path, text=None):
+    with open(path, 'rb') as f:
+        return TokenFile(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), text)
+
+_module_hashes = {}
+
+def _module_hash(module_name):
+    result = _module_hashes.get(module_name)
+    if result is None:
+        digest = hashlib.sha256()
+        fname = getattr(sys.modules.get(module_name), '__file__', None)
+        if fname:
+            with open(fname, 'rb') as f:
+                digest.update(f.read())
+        result = _module_hashes[module_name] = digest.hexdigest()
+    return result
+
+# Fingerprint of the tokenizers in stages and the code defining them, so
+# that editing the lexer invalidates cached token files.
+def grammar_version(stages):
+    digest = hashlib.sha256(str(FORMAT_VERSION).encode())
+    for stage in stages:
+        for tokenizer in stage.tokenizers:
+            module = getattr(tokenizer, '__module__', None)
+            digest.update('{}.{}:{}\0'.format(
+                module, getattr(tokenizer, '__qualname__', repr(tokenizer)),
+                _module_hash(module)).encode())
+        digest.update(b'\1')
+    return digest.hexdigest()
+
+class LexCache:
+    def __init__(self, cache_dir, stages=None, max_lookback=None):
+        self.cache_dir = cache_dir
+        self.stages = (
+            [CharacterParser, StringParser] if stages is None else stages)
+        self.max_lookback = max_lookback
+        self.version = grammar_version(self.stages)
+
+    def key(self, fname, data):
+        # The file name is part of the output (the Filename token).
+        digest = hashlib.sha256(self.version.encode())
+        digest.update(repr((fname, self.max_lookback)).encode())
+        digest.update(b'\0')
+        digest.update(data)
+        return digest.hexdigest()
+
+    def _lex(self, fname, text):
+        stream = ReversibleIterator(
+            TextSource(text, 0, fname, PositionIndex(text)), self.max_lookback)
+        for stage in self.stages:
+            stream = Parser(stage.tokenizers).parse(stream)
+
+        while True:
+            token = stream.next()
+            if token is None:
+                return
+            yield token
+
+    def tokens(self, fname):
+        with open(fname, 'rb') as f:
+            data = f.read()
+
+        # Decoded the same way FileSource reads files.
+        text = ''.join(normalize_newlines((
+            data.decode(locale.getpreferredencoding(False)),)))
+        path = os.path.join(self.cache_dir, self.key(fname, data) + '.tok')
+        if not os.path.exists(path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_tokens(path, self._lex(fname, text), text)
+
+        return read_tokens(path, text)
@@ -1,112 +1,215 @@
 
 import collections.abc
 import functools
+import hashlib
 import json
-import weakref
+import os
+import zipfile
+
+import numpy
 
 functools.lru_cache
 
 functools.cached_property
 
-class MenuEntry:
-    def __init__(self, parent, key):
-        self.parent = weakref.proxy(parent)
-        self.key = key
-
-    @functools.cached_property
-    def obj(self):
-        return self.parent._data.get(self.key) or {}
+# Bump when the layout of a compiled table changes, so old cache files are
+# ignored.
+CACHE_VERSION = 2
 
-    @functools.cached_property
-    def description(self):
-        return self.obj.get('desc') or self.key
+nut_attrs = 'kcgpsf'
+nut_names = ('calories', 'carbs', 'fat', 'protein', 'sodium', 'fiber')
+columns = nut_names + ('increment', 'unit_count', 'min_nz_count')
 
-    @functools.cached_property
-    def increment(self):
-        return self.obj.get('inc') or 1.0
-
-    @functools.cached_property
-    def unit_count(self):
-        count = self.obj.get('count') or 1
-        if isinstance(count, list):
-            count = count[1] if len(count) > 1 else 1
-        return count
+class RecipeCycleError(ValueError): pass
 
-    @functools.cached_property
-    def min_nz_count(self):
-        count = self.obj.get('count') or 1
-        if isinstance(count, list):
-            count = count[0] if len(count) > 0 else 1
-        return count
-
-    @functools.cached_property
-    def unit(self):
-        return self.obj.get('unit') or 'unit'
+class MenuEntry:
+    __slots__ = ('key', 'index', 'description', 'unit') + columns
 
-    @functools.cached_property
+    @property
     def nut_block(self):
+        return {a: getattr(self, name) for a, name in zip(nut_attrs, nut_names)}
+
+# Keys of data ordered so that every recipe comes after its ingredients.
+def _resolve_order(data):
+    order = []
+    done = set()
+    path = []
+    on_path = set()
+
+    def visit(key):
+        if key in done:
+            return
+        if key in on_path:
+            cycle = path[path.index(key):] + [key]
+            raise RecipeCycleError('recipe cycle: {}'.format(' -> '.join(cycle)))
+
+        path.append(key)
+        on_path.add(key)
+        for x in (data.get(key) or {}).get('ingredients', ()):
+            if isinstance(x, str):
+                visit(x)
+        path.pop()
+        on_path.remove(key)
+
+        done.add(key)
+        order.append(key)
+
+    for key in data:
+        visit(key)
+    return order
+
+# Resolves the recipes in parsed db.json data into one row per key: lists of
+# keys, descriptions and units, and a (columns x rows) array of the numbers.
+def compile_db(data):
+    blocks = {}
+    for key in _resolve_order(data):
+        obj = data.get(key) or {}
         try:
-            ingredients = self.obj['ingredients']
+            ingredients = obj['ingredients']
         except KeyError:
-            return self.obj
+            blocks[key] = obj
+            continue
 
         result = {}
-        attrs = 'kcgpsf'
         factor = 1.0
-
         for x in ingredients:
             if isinstance(x, str):
-                parent_obj = self.parent.get(x).nut_block
-                for a in attrs:
+                parent_obj = blocks[x]
+                for a in nut_attrs:
                     result[a] = (
                         result.get(a, 0) + round(factor*parent_obj.get(a, 0)))
                 factor = 1.0
             else:
                 factor = x
+        blocks[key] = result
 
-        return result
+    keys = list(data)
+    descriptions = []
+    units = []
+    values = numpy.empty((len(columns), len(keys)))
 
-    @functools.cached_property
-    def calories(self):
-        return self.nut_block.get('k', 0)
+    for i, key in enumerate(keys):
+        obj = data[key] or {}
+        descriptions.append(obj.get('desc') or key)
+        units.append(obj.get('unit') or 'unit')
 
-    @functools.cached_property
-    def carbs(self):
-        return self.nut_block.get('c', 0)
+        nut_block = blocks[key]
+        for j, a in enumerate(nut_attrs):
+            values[j, i] = nut_block.get(a, 0)
 
-    @functools.cached_property
-    def fat(self):
-        return self.nut_block.get('g', 0)
-
-    @functools.cached_property
-    def protein(self):
-        return self.nut_block.get('p', 0)
+        count = obj.get('count') or 1
+        if isinstance(count, list):
+            unit_count = count[1] if len(count) > 1 else 1
+            min_nz_count = count[0] if len(count) > 0 else 1
+        else:
+            unit_count = min_nz_count = count
+
+        values[len(nut_attrs):, i] = (
+            obj.get('inc') or 1.0, unit_count, min_nz_count)
+
+    return {
+        'keys': keys,
+        'descriptions': descriptions,
+        'units': units,
+        'values': values,
+    }
+
+def _read_cache(path):
+    with numpy.load(path, allow_pickle=False) as cache:
+        table = {
+            'keys': cache['keys'].tolist(),
+            'descriptions': cache['descriptions'].tolist(),
+            'units': cache['units'].tolist(),
+            'values': cache['values'],
+        }
+
+    n = len(table['keys'])
+    if (len(table['descriptions']) != n or len(table['units']) != n or
+            table['values'].shape != (len(columns), n)):
+        raise ValueError('malformed menu cache')
+    return table
+
+# Entries are made on first access; self.columns maps each name in columns
+# to its numpy column, indexed by MenuEntry.index.
+class MenuDB(collections.abc.Mapping, collections.abc.Hashable):
+    def __init__(self, f, cache_dir=None):
+        source = f.read()
+        if cache_dir is None:
+            self._load(compile_db(json.loads(source)))
+            return
 
-    @functools.cached_property
-    def sodium(self):
-        return self.nut_block.get('s', 0)
+        raw = source.encode() if isinstance(source, str) else source
+        digest = hashlib.sha256(str(CACHE_VERSION).encode())
+        digest.update(raw)
+        path = os.path.join(cache_dir, digest.hexdigest() + '.npz')
 
-    @functools.cached_property
-    def fiber(self):
-        return self.nut_block.get('f', 0)
+        try:
+            self._load(_read_cache(path))
+            return
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            # Missing, stale or foreign: compile again and replace it.
+            pass
 
+        table = compile_db(json.loads(source))
+        self._load(table)
 
-class MenuDB(collections.abc.Mapping, collections.abc.Hashable):
-    def __init__(self, f):
-        self._data = json.load(f)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as cache:
+                numpy.savez(
+                    cache,
+                    keys=numpy.array(table['keys'], dtype=str),
+                    descriptions=numpy.array(table['descriptions'], dtype=str),
+                    units=numpy.array(table['units'], dtype=str),
+                    values=table['values'])
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _load(self, table):
+        self._keys = table['keys']
+        self._descriptions = table['descriptions']
+        self._units = table['units']
+        self.columns = dict(zip(columns, table['values']))
+        self._index = {key: i for i, key in enumerate(self._keys)}
+        self._entries = {}
 
     def __hash__(self):
         return id(self)
 
-    @functools.lru_cache
     def __getitem__(self, key):
-        return MenuEntry(self, key)
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+
+        entry = MenuEntry()
+        entry.key = key
+        index = self._index.get(key)
+        entry.index = index
+        if index is None:
+            # Unknown keys read as an empty entry, as they always have.
+            entry.description = key
+            entry.unit = 'unit'
+            for name in columns:
+                setattr(entry, name, 0.0)
+            entry.increment = entry.unit_count = entry.min_nz_count = 1.0
+        else:
+            entry.description = self._descriptions[index]
+            entry.unit = self._units[index]
+            for name in columns:
+                setattr(entry, name, self.columns[name][index].item())
+
+        self._entries[key] = entry
+        return entry
 
     def __iter__(self):
-        return iter(self._data)
+        return iter(self._keys)
 
     def __len__(self):
-        return len(self._data)
+        return len(self._keys)
 
 
 class HealthProfile:
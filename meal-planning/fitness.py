@@ -0,0 +1,384 @@
+from multiprocessing import Pool, shared_memory
+import os
+import random
+import weakref
+
+import numpy
+
+nutrients = ('calories', 'carbs', 'fat', 'protein', 'sodium', 'fiber')
+
+class NutrientTable:
+    def __init__(self, db, menu):
+        selections = menu['selections']
+        self.keys = list(selections.keys())
+        n = len(self.keys)
+
+        self.increment = numpy.empty(n)
+        self.min_nz_count = numpy.empty(n)
+        self.selection_min = numpy.full(n, numpy.nan)
+        self.selection_max = numpy.full(n, numpy.nan)
+        self.nutrients = numpy.empty((len(nutrients), n))
+
+        for i, key in enumerate(self.keys):
+            entry = db[key]
+            selection_entry = selections[key] or {}
+
+            self.increment[i] = entry.increment
+            self.min_nz_count[i] = entry.min_nz_count
+            if selection_entry.get('min') is not None:
+                self.selection_min[i] = selection_entry['min']
+            if selection_entry.get('max') is not None:
+                self.selection_max[i] = selection_entry['max']
+
+            for j, name in enumerate(nutrients):
+                self.nutrients[j, i] = getattr(entry, name)
+
+        size = menu.get('size', {})
+        self.size_min = size.get('min')
+        # evaluate() checks the upper bound against size['min'] too.
+        self.size_max = size.get('min')
+
+    def to_array(self, out=None):
+        if out is None:
+            out = numpy.empty((4 + len(nutrients), len(self.keys)))
+        out[0] = self.increment
+        out[1] = self.min_nz_count
+        out[2] = self.selection_min
+        out[3] = self.selection_max
+        out[4:] = self.nutrients
+        return out
+
+    @classmethod
+    def from_array(cls, array, size_min, size_max):
+        table = cls.__new__(cls)
+        table.keys = None
+        table.increment = array[0]
+        table.min_nz_count = array[1]
+        table.selection_min = array[2]
+        table.selection_max = array[3]
+        table.nutrients = array[4:]
+        table.size_min = size_min
+        table.size_max = size_max
+        return table
+
+def targets(profile):
+    return (
+        profile.adjusted_calorie_target,
+        profile.carbs_target,
+        profile.fat_target,
+        profile.protein_target,
+        profile.sodium_target,
+        profile.fiber_target)
+
+def _below(x):
+    # -min(x, 0), keeping min's choice of operand.
+    return numpy.where(x > 0, 0.0, -x)
+
+def _above(x):
+    # max(x, 0), keeping max's choice of operand.
+    return numpy.where(x < 0, 0.0, x)
+
+# Scores an (individuals x selections) array of genes the way main.evaluate
+# scores one individual, summing in the same order so results are identical.
+def score(table, targets, genes):
+    genes = numpy.asarray(genes, dtype=float)
+    m, n = genes.shape
+
+    totals = numpy.zeros((len(nutrients), m))
+    neg_penalty = numpy.zeros(m)
+    non_int_penalty = numpy.zeros(m)
+    min_nz_penalty = numpy.zeros(m)
+    selection_penalty = numpy.zeros(m)
+    num_items = numpy.zeros(m)
+
+    for i in range(n):
+        servings = genes[:, i]
+        non_int_penalty += 0.5*(1 - numpy.cos(2*numpy.pi*servings))
+        servings = numpy.round(servings)
+
+        neg_penalty -= numpy.minimum(servings, 0)
+        servings = numpy.maximum(servings, 0)
+        nonzero = servings > 0
+        num_items += nonzero
+
+        mn = table.selection_min[i]
+        if not numpy.isnan(mn):
+            selection_penalty += numpy.where(servings < mn, mn - servings, 0)
+
+        mx = table.selection_max[i]
+        if not numpy.isnan(mx):
+            selection_penalty += numpy.where(mx < servings, servings - mx, 0)
+
+        nz = table.min_nz_count[i]
+        min_nz_penalty += numpy.where(
+            nonzero & (servings < nz), nz - servings, 0)
+
+        factor = table.increment[i]*servings
+        for j in range(len(nutrients)):
+            totals[j] += factor*table.nutrients[j, i]
+
+    k, c, g, p, s, f = totals
+    k0, c0, g0, p0, s0, f0 = targets
+
+    k1 = 1.0*k0
+    c1 = 1.1*c0
+    g1 = 1.05*g0
+    p1 = 1.1*p0
+    s1 = 1.2*s0
+    f1 = 1.4*f0
+
+    wrds = (_below((k-k0)/k0) + 4.0*_above((k-k1)/k1) +
+            _below((c-c0)/c0) + 4.0*_above((c-c1)/c1) +
+            _below((g-g0)/g0) + 4.0*_above((g-g1)/g1) +
+            4.0*(_below((p-p0)/p0) + 4.0*_above((p-p1)/p1)) +
+            _below((s-s0)/s0) + 4.0*_above((s-s1)/s1) +
+            _below((f-f0)/f0) + 4.0*_above((f-f1)/f1))
+
+    non_int_penalty /= n
+    neg_penalty /= n
+
+    menu_constraint_penalty = numpy.zeros(m)
+    if table.size_min is not None:
+        menu_constraint_penalty += numpy.where(
+            num_items < table.size_min, table.size_min - num_items, 0)
+    if table.size_max is not None:
+        menu_constraint_penalty += numpy.where(
+            table.size_max < num_items, num_items - table.size_max, 0)
+
+    penalty = (neg_penalty +
+               non_int_penalty +
+               min_nz_penalty +
+               selection_penalty +
+               menu_constraint_penalty)
+
+    return (wrds + penalty)*numpy.exp(penalty)
+
+class BatchEvaluator:
+    def __init__(self, db, menu, profile):
+        self.table = NutrientTable(db, menu)
+        self.targets = targets(profile)
+
+    def scores(self, individuals):
+        return score(self.table, self.targets, individuals)
+
+    def evaluate(self, individual):
+        return (float(self.scores([individual])[0]),)
+
+    def map(self, func, individuals):
+        # Registered as toolbox.map: evaluations of a whole generation are
+        # scored in one pass, anything else is mapped as usual.
+        if getattr(func, 'func', func) != self.evaluate:
+            return map(func, individuals)
+
+        individuals = list(individuals)
+        if not individuals:
+            return []
+        return [(float(x),) for x in self.scores(individuals)]
+
+# Worker side of ParallelEvaluator: the table is attached from shared memory
+# once per process, after which only gene arrays and scores are exchanged.
+_worker = None
+
+def _init_worker(name, shape, size_min, size_max, targets):
+    global _worker
+    memory = shared_memory.SharedMemory(name=name)
+    array = numpy.ndarray(shape, dtype=float, buffer=memory.buf)
+    _worker = (
+        memory, NutrientTable.from_array(array, size_min, size_max), targets)
+
+def _score_chunk(genes):
+    _, table, targets = _worker
+    return score(table, targets, genes)
+
+def _release(pool, memory):
+    if pool is not None:
+        pool.terminate()
+    memory.close()
+    memory.unlink()
+
+class ParallelEvaluator(BatchEvaluator):
+    def __init__(self, db, menu, profile, processes=None):
+        super().__init__(db, menu, profile)
+        self.processes = processes or os.cpu_count()
+        self.pool = None
+        self._finalizer = None
+
+    def _start(self):
+        array = self.table.to_array()
+        memory = shared_memory.SharedMemory(create=True, size=array.nbytes)
+        self.table.to_array(
+            numpy.ndarray(array.shape, dtype=float, buffer=memory.buf))
+
+        self.pool = Pool(
+            self.processes, initializer=_init_worker, initargs=(
+                memory.name, array.shape, self.table.size_min,
+                self.table.size_max, self.targets))
+        self._finalizer = weakref.finalize(
+            self, _release, self.pool, memory)
+
+    def scores(self, individuals):
+        if self.pool is None:
+            self._start()
+
+        genes = numpy.asarray(individuals, dtype=float)
+        chunks = numpy.array_split(genes, self.processes)
+        return numpy.concatenate(self.pool.map(
+            _score_chunk, [chunk for chunk in chunks if len(chunk)]))
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+            self.pool = None
+            self._finalizer = None
+
+# Deltas are exact for the integer-valued penalty terms but not for the float
+# sums, so an individual is rescored from scratch after this many.
+REFRESH = 16
+
+# Running sums behind an individual's fitness, and the genes changed since
+# they were last applied, as (index, old, new).
+class _Terms:
+    def __init__(self, sums):
+        self.sums = sums
+        self.age = 0
+        self.changes = []
+
+# Keeps evaluate's sums on each individual (toolbox.clone copies them).
+# mate and mutate are cxTwoPoint and mutFlipBit with the same random draws,
+# noting the genes they change, so offspring only rescore those genes.
+class DeltaEvaluator:
+    def __init__(self, db, menu, profile, refresh=REFRESH):
+        table = NutrientTable(db, menu)
+        self.refresh = refresh
+        self.targets = targets(profile)
+        self.size_min = table.size_min
+        self.size_max = table.size_max
+        self.increment = table.increment.tolist()
+        self.min_nz_count = table.min_nz_count.tolist()
+        self.selection_min = [
+            None if numpy.isnan(x) else x for x in table.selection_min]
+        self.selection_max = [
+            None if numpy.isnan(x) else x for x in table.selection_max]
+        self.nutrients = table.nutrients.T.tolist()
+
+    def _add(self, sums, i, servings, sign):
+        non_int_penalty = 0.5*(1 - numpy.cos(2*numpy.pi*servings))
+        servings = int(round(servings))
+
+        neg_penalty = 0
+        if servings < 0:
+            neg_penalty = -servings
+            servings = 0
+
+        selection_penalty = 0
+        mn = self.selection_min[i]
+        if mn is not None and servings < mn:
+            selection_penalty += mn - servings
+        mx = self.selection_max[i]
+        if mx is not None and mx < servings:
+            selection_penalty += servings - mx
+
+        min_nz_penalty = 0
+        nz = self.min_nz_count[i]
+        if servings > 0 and servings < nz:
+            min_nz_penalty = nz - servings
+
+        factor = self.increment[i]*servings
+        for j, x in enumerate(self.nutrients[i]):
+            sums[j] += sign*(factor*x)
+
+        sums[6] += sign*non_int_penalty
+        sums[7] += sign*neg_penalty
+        sums[8] += sign*selection_penalty
+        sums[9] += sign*min_nz_penalty
+        sums[10] += sign*(servings > 0)
+
+    def _sums(self, individual):
+        sums = [0.0]*(len(nutrients) + 5)
+        for i, servings in enumerate(individual):
+            self._add(sums, i, servings, 1)
+        return sums
+
+    def _score(self, sums, num_attrs):
+        k, c, g, p, s, f = sums[:len(nutrients)]
+        (non_int_penalty, neg_penalty, selection_penalty, min_nz_penalty,
+         num_items) = sums[len(nutrients):]
+        k0, c0, g0, p0, s0, f0 = self.targets
+
+        k1 = 1.0*k0
+        c1 = 1.1*c0
+        g1 = 1.05*g0
+        p1 = 1.1*p0
+        s1 = 1.2*s0
+        f1 = 1.4*f0
+
+        wrds = (-min((k-k0)/k0, 0) + 4.0*max((k-k1)/k1, 0) +
+                -min((c-c0)/c0, 0) + 4.0*max((c-c1)/c1, 0) +
+                -min((g-g0)/g0, 0) + 4.0*max((g-g1)/g1, 0) +
+                4.0*(-min((p-p0)/p0, 0) + 4.0*max((p-p1)/p1, 0)) +
+                -min((s-s0)/s0, 0) + 4.0*max((s-s1)/s1, 0) +
+                -min((f-f0)/f0, 0) + 4.0*max((f-f1)/f1, 0))
+
+        non_int_penalty /= num_attrs
+        neg_penalty /= num_attrs
+
+        menu_constraint_penalty = 0
+        if self.size_min is not None and num_items < self.size_min:
+            menu_constraint_penalty += self.size_min - num_items
+        if self.size_max is not None and self.size_max < num_items:
+            menu_constraint_penalty += num_items - self.size_max
+
+        penalty = (neg_penalty +
+                   non_int_penalty +
+                   min_nz_penalty +
+                   selection_penalty +
+                   menu_constraint_penalty)
+
+        return (wrds + penalty)*numpy.exp(penalty)
+
+    def evaluate(self, individual):
+        terms = getattr(individual, 'terms', None)
+        if (terms is None or terms.age >= self.refresh or
+                len(terms.changes) >= len(individual)):
+            terms = individual.terms = _Terms(self._sums(individual))
+        elif terms.changes:
+            sums = terms.sums
+            for i, old, new in terms.changes:
+                self._add(sums, i, old, -1)
+                self._add(sums, i, new, 1)
+            terms.age += 1
+            terms.changes = []
+
+        return (self._score(terms.sums, len(individual)),)
+
+    def _set(self, individual, i, value):
+        old = individual[i]
+        individual[i] = value
+        terms = getattr(individual, 'terms', None)
+        if terms is not None and individual[i] != old:
+            terms.changes.append((i, old, individual[i]))
+
+    # tools.cxTwoPoint
+    def mate(self, ind1, ind2):
+        size = min(len(ind1), len(ind2))
+        cxpoint1 = random.randint(1, size)
+        cxpoint2 = random.randint(1, size - 1)
+        if cxpoint2 >= cxpoint1:
+            cxpoint2 += 1
+        else:
+            cxpoint1, cxpoint2 = cxpoint2, cxpoint1
+
+        for i in range(cxpoint1, cxpoint2):
+            x1, x2 = ind1[i], ind2[i]
+            self._set(ind1, i, x2)
+            self._set(ind2, i, x1)
+
+        return ind1, ind2
+
+    # tools.mutFlipBit
+    def mutate(self, individual, indpb):
+        for i in range(len(individual)):
+            if random.random() < indpb:
+                self._set(individual, i, type(individual[i])(not individual[i]))
+
+        return individual,
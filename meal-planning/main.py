@@ -8,11 +8,13 @@ import scipy
 
 from deap import algorithms, base, creator, tools
 from data import MenuDB, HealthProfile
+from fitness import BatchEvaluator, DeltaEvaluator, ParallelEvaluator
 from lib import tee
+from solver import solve
 
 
 with open('./db.json') as f:
-    db = MenuDB(f)
+    db = MenuDB(f, cache_dir='./__menucache__')
 
 with open('./menu.json') as f:
     menu = json.load(f)
@@ -32,6 +34,17 @@ LAMBDA = 100
 CXPB = 0.7
 MUTPB = 0.2
 
+# 'scalar' scores individuals one at a time with evaluate(); 'batch' scores
+# each generation as one array (same results, see fitness.py); 'parallel'
+# splits that array over a process pool; 'delta' rescores offspring from
+# the genes that mate and mutate changed in their parents.
+EVALUATION = 'batch'
+PROCESSES = None
+
+# 'ga' evolves a plan with the genetic algorithm below; 'milp' solves for the
+# best plan that meets every menu constraint exactly (see solver.py).
+METHOD = 'ga'
+
 # creator.create("Fitness", base.Fitness,
 #         weights=(-1.0, -1.0, -1000000*float(num_selections)))
 creator.create("Fitness", base.Fitness, weights=(-1.0,))
@@ -160,35 +173,32 @@ def evaluate(individual):
     return ((wrds + penalty)*numpy.exp(penalty),)
     # return (neg_penalty, non_int_penalty, wrds)
 
-toolbox.register("evaluate", evaluate)
-toolbox.register("mate", tools.cxTwoPoint)
-toolbox.register("mutate", tools.mutFlipBit, indpb=0.05)
+batch = None
+delta = None
+if EVALUATION == 'batch':
+    batch = BatchEvaluator(db, menu, P)
+elif EVALUATION == 'parallel':
+    batch = ParallelEvaluator(db, menu, P, PROCESSES)
+elif EVALUATION == 'delta':
+    delta = DeltaEvaluator(db, menu, P)
+
+if batch is not None:
+    toolbox.register("evaluate", batch.evaluate)
+    toolbox.register("map", batch.map)
+elif delta is not None:
+    toolbox.register("evaluate", delta.evaluate)
+else:
+    toolbox.register("evaluate", evaluate)
+
+if delta is not None:
+    toolbox.register("mate", delta.mate)
+    toolbox.register("mutate", delta.mutate, indpb=0.05)
+else:
+    toolbox.register("mate", tools.cxTwoPoint)
+    toolbox.register("mutate", tools.mutFlipBit, indpb=0.05)
 # toolbox.register("select", tools.selNSGA2)
 toolbox.register("select", tools.selTournament, tournsize=3)
 
-pop = toolbox.population(n=MU)
-# hof = tools.ParetoFront()
-hof = tools.HallOfFame(1)
-stats = tools.Statistics(lambda ind: ind.fitness.values)
-stats.register("avg", numpy.mean, axis=0)
-stats.register("std", numpy.std, axis=0)
-stats.register("min", numpy.min, axis=0)
-stats.register("max", numpy.max, axis=0)
-
-# algorithms.eaMuPlusLambda(
-#     pop, toolbox, MU, LAMBDA, CXPB, MUTPB, NGEN, stats, halloffame=hof)
-pop, log = algorithms.eaSimple(
-    pop, toolbox, cxpb=CXPB, mutpb=MUTPB, ngen=NGEN, stats=stats,
-    halloffame=hof, verbose=True)
-
-from pprint import pprint
-pprint(stats.compile(pop))
-pprint(stats.compile(hof))
-pprint(hof)
-
-
-print('\n\n\n')
-
 def display_individual(ind):
     k, c, g, p, s, f = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
     for i, servings in enumerate(ind):
@@ -243,7 +253,48 @@ def display_individual(ind):
         ', '.join(str(x) for x in ind.fitness.getValues())))
     print('')
 
-with open('plans.txt', 'a') as f:
-    with tee(f):
-        display_individual(hof[0])
 
+def run_ga():
+    pop = toolbox.population(n=MU)
+    # hof = tools.ParetoFront()
+    hof = tools.HallOfFame(1)
+    stats = tools.Statistics(lambda ind: ind.fitness.values)
+    stats.register("avg", numpy.mean, axis=0)
+    stats.register("std", numpy.std, axis=0)
+    stats.register("min", numpy.min, axis=0)
+    stats.register("max", numpy.max, axis=0)
+
+    # algorithms.eaMuPlusLambda(
+    #     pop, toolbox, MU, LAMBDA, CXPB, MUTPB, NGEN, stats, halloffame=hof)
+    pop, log = algorithms.eaSimple(
+        pop, toolbox, cxpb=CXPB, mutpb=MUTPB, ngen=NGEN, stats=stats,
+        halloffame=hof, verbose=True)
+
+    from pprint import pprint
+    pprint(stats.compile(pop))
+    pprint(stats.compile(hof))
+    pprint(hof)
+
+    return hof[0]
+
+def run_milp():
+    servings, _ = solve(db, menu, P)
+    ind = creator.Individual(servings)
+    ind.fitness.values = evaluate(ind)
+    return ind
+
+
+if __name__ == '__main__':
+    if METHOD == 'milp':
+        best = run_milp()
+    else:
+        best = run_ga()
+
+    print('\n\n\n')
+
+    with open('plans.txt', 'a') as f:
+        with tee(f):
+            display_individual(best)
+
+    if isinstance(batch, ParallelEvaluator):
+        batch.close()
@@ -0,0 +1,96 @@
+import numpy
+from scipy.optimize import Bounds, LinearConstraint, milp
+
+from fitness import NutrientTable, targets
+
+# Upper bound on the servings of a selection that has no 'max' of its own.
+# The nutrient limits make larger counts pointless, but the solver needs a
+# finite bound to tie each selection's servings to its on/off variable.
+MAX_SERVINGS = 50
+
+# Relative tolerance of the upper target of each nutrient (see evaluate) and
+# the weight of falling short of each target; going over weighs 4x more.
+upper = (1.0, 1.1, 1.05, 1.1, 1.2, 1.4)
+weights = (1.0, 1.0, 1.0, 4.0, 1.0, 1.0)
+
+# Finds the integer servings minimizing evaluate() among plans with no
+# penalty, where fitness is the weighted distance to the targets. Variables
+# are servings x and on/off flags y per selection, then the relative
+# shortfall u and excess o per nutrient, which keep the objective linear.
+def solve(db, menu, profile, max_servings=MAX_SERVINGS, time_limit=None):
+    table = NutrientTable(db, menu)
+    n = len(table.keys)
+    m = len(table.nutrients)
+    lower = numpy.array(targets(profile), dtype=float)
+    higher = lower*upper
+
+    x = slice(0, n)
+    y = slice(n, 2*n)
+    u = slice(2*n, 2*n + m)
+    o = slice(2*n + m, 2*n + 2*m)
+    size = 2*n + 2*m
+
+    c = numpy.zeros(size)
+    c[u] = weights
+    c[o] = 4.0*numpy.array(weights)
+
+    x_min = numpy.nan_to_num(table.selection_min, nan=0.0)
+    x_max = numpy.fmin(table.selection_max, max_servings)
+    lb = numpy.zeros(size)
+    ub = numpy.full(size, numpy.inf)
+    lb[x] = x_min
+    ub[x] = x_max
+    ub[y] = 1
+
+    integrality = numpy.zeros(size)
+    integrality[x] = 1
+    integrality[y] = 1
+
+    constraints = []
+
+    # Nutrient totals: total + lower*u >= lower and total - higher*o <= higher.
+    totals = table.nutrients*table.increment
+    A = numpy.zeros((m, size))
+    A[:, x] = totals
+    A[:, u] = numpy.diag(lower)
+    constraints.append(LinearConstraint(A, lower, numpy.inf))
+
+    A = numpy.zeros((m, size))
+    A[:, x] = totals
+    A[:, o] = -numpy.diag(higher)
+    constraints.append(LinearConstraint(A, -numpy.inf, higher))
+
+    # Servings are 0 when a selection is off and between min_nz_count (and
+    # at least 1) and the upper bound when it is on.
+    eye = numpy.eye(n)
+    A = numpy.zeros((n, size))
+    A[:, x] = eye
+    A[:, y] = -numpy.diag(x_max)
+    constraints.append(LinearConstraint(A, -numpy.inf, 0))
+
+    A = numpy.zeros((n, size))
+    A[:, x] = eye
+    A[:, y] = -numpy.diag(numpy.maximum(table.min_nz_count, 1))
+    constraints.append(LinearConstraint(A, 0, numpy.inf))
+
+    # Number of selections on the menu.
+    if table.size_min is not None or table.size_max is not None:
+        A = numpy.zeros((1, size))
+        A[0, y] = 1
+        constraints.append(LinearConstraint(
+            A,
+            -numpy.inf if table.size_min is None else table.size_min,
+            numpy.inf if table.size_max is None else table.size_max))
+
+    options = {}
+    if time_limit is not None:
+        options['time_limit'] = time_limit
+
+    result = milp(
+        c, integrality=integrality, bounds=Bounds(lb, ub),
+        constraints=constraints, options=options)
+    if result.x is None:
+        raise ValueError('no meal plan meets the menu constraints: {}'.format(
+            result.message))
+
+    return [float(v) for v in numpy.round(result.x[x])], result.fun